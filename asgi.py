@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Альтернативный запуск на ASGI-сервере:
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+# Хэндлеры, база и метрики берутся из bot.py без изменений. Апдейт в /webhook
+# становится задачей в цикле событий, а не потоком: групповые сообщения (только
+# XP в памяти) разбираются прямо в цикле, команды и меню с запросами к SQLite —
+# в небольшом пуле потоков. Ответы хэндлеров уходят в Telegram асинхронно через
+# httpx, поэтому медленный Bot API не держит ни поток, ни слот пула.
+
+import os
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from telegram import Bot, InputFile, Update
+from telegram.error import RetryAfter, TelegramError
+
+import bot as core
+
+# ==============================================================================
+# КОНСТАНТЫ
+# ==============================================================================
+
+ASGI_HANDLER_THREADS = int(os.getenv("ASGI_HANDLER_THREADS", "8"))
+ASGI_MAX_IN_FLIGHT   = int(os.getenv("ASGI_MAX_IN_FLIGHT", "10000"))  # апдейтов в обработке на процесс
+ASGI_API_TIMEOUT     = float(os.getenv("ASGI_API_TIMEOUT", "20"))
+ASGI_API_RETRIES     = int(os.getenv("ASGI_API_RETRIES", "3"))         # повторов после RetryAfter
+ASGI_DRAIN_TIMEOUT   = float(os.getenv("ASGI_DRAIN_TIMEOUT", "10"))   # ожидание хвоста при остановке
+
+logger = logging.getLogger(__name__)
+
+ASGI_UPDATES = core.metrics.counter("faba_asgi_updates_total", "Апдейты, пришедшие в ASGI /webhook, по исходу")
+
+# Методы, результат которых хэндлеры не читают; остальные (getMe, getChat и т. п.)
+# выполняются обычным блокирующим вызовом
+DEFERRED_METHODS = {
+    "sendMessage", "copyMessage", "forwardMessage", "sendChatAction",
+    "editMessageText", "deleteMessage",
+}
+
+HTTP_ERRORS = {400: "BadRequest", 401: "Unauthorized", 403: "Unauthorized", 409: "Conflict"}
+
+# ==============================================================================
+# НЕБЛОКИРУЮЩИЕ ВЫЗОВЫ BOT API
+# ==============================================================================
+
+class DeferredRequest(core.InstrumentedRequest):
+    # Хэндлер не ждёт ответа Telegram: вызов из DEFERRED_METHODS уходит
+    # корутиной в цикл событий, а Bot получает True, как от методов без тела
+    # ответа. Ни один хэндлер не использует возвращённое сообщение, а ошибки
+    # отправки попадают в лог и faba_bot_api_errors_total. Загрузка файлов
+    # (/senddb) идёт обычным блокирующим путём — она и так в пуле потоков.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.client = client
+        self.pending = set()
+
+    def post(self, url, data=None, timeout=None):
+        data = data or {}
+        method = url.rsplit("/", 1)[-1]
+        if method not in DEFERRED_METHODS or any(isinstance(value, InputFile) for value in data.values()):
+            return super().post(url, data, timeout)
+        future = asyncio.run_coroutine_threadsafe(self._deliver(url, data), self.loop)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return True
+
+    async def _deliver(self, url: str, data: dict):
+        method = url.rsplit("/", 1)[-1]
+        body = json.dumps(data).encode("utf-8")
+        for attempt in range(ASGI_API_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                response = await self.client.post(
+                    url, content=body, headers={"Content-Type": "application/json"}
+                )
+                result = self._parse(response.content)
+            except RetryAfter as e:
+                core.API_SECONDS.observe(time.perf_counter() - started, method=method)
+                if attempt == ASGI_API_RETRIES:
+                    error = e
+                    break
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (httpx.HTTPError, TelegramError) as e:
+                core.API_SECONDS.observe(time.perf_counter() - started, method=method)
+                error = e
+                break
+            core.API_SECONDS.observe(time.perf_counter() - started, method=method)
+            if response.is_success:
+                return
+            core.API_ERRORS.inc(method=method, error=HTTP_ERRORS.get(response.status_code, "NetworkError"))
+            logger.error(f"Bot API {method}: {result} ({response.status_code})")
+            return
+        core.API_ERRORS.inc(method=method, error=type(error).__name__)
+        logger.error(f"Bot API {method}: {error}")
+
+    async def drain(self, timeout: float):
+        if self.pending:
+            await asyncio.wait([asyncio.wrap_future(f) for f in list(self.pending)], timeout=timeout)
+
+# ==============================================================================
+# ОБРАБОТКА АПДЕЙТОВ
+# ==============================================================================
+
+class AsgiRuntime:
+    # Состояние одного процесса: HTTP-клиент, Bot для ответов хэндлеров,
+    # пул потоков для SQLite и набор задач, которые ещё обрабатываются
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.client = httpx.AsyncClient(timeout=ASGI_API_TIMEOUT)
+        self.request = DeferredRequest(self.loop, self.client, connect_timeout=20, read_timeout=20)
+        self.bot = Bot(token=core.BOT_TOKEN, request=self.request)
+        self.executor = ThreadPoolExecutor(max_workers=ASGI_HANDLER_THREADS, thread_name_prefix="asgi-handler")
+        self.tasks = set()
+
+    async def start(self):
+        # CommandHandler сверяет /cmd@имя_бота, поэтому getMe нужен заранее,
+        # чтобы первый же апдейт не ждал его в цикле событий
+        try:
+            await self.loop.run_in_executor(self.executor, self.bot.get_me)
+        except Exception as e:
+            logger.error(f"Не удалось получить профиль бота: {e}")
+
+    def submit(self, data: dict) -> bool:
+        if len(self.tasks) >= ASGI_MAX_IN_FLIGHT:
+            ASGI_UPDATES.inc(outcome="rejected")
+            return False
+        task = self.loop.create_task(self._process(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        ASGI_UPDATES.inc(outcome="accepted")
+        return True
+
+    async def _process(self, data: dict):
+        # Сообщение группы задевает только record_xp: лимитер, буфер записи и
+        # рейтинг в памяти — его дешевле разобрать прямо в цикле событий, и
+        # команды админов в пуле потоков не стоят за ним в очереди
+        received = time.perf_counter()
+        kind = "passive"
+        try:
+            update = Update.de_json(data, self.bot)
+            kind = core.classify_update(update)
+            if kind == "passive":
+                core.process_update_traced(update, kind)
+            else:
+                await self.loop.run_in_executor(
+                    self.executor, core.process_update_traced, update, kind, received
+                )
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта: {e}")
+        finally:
+            core.UPDATE_SECONDS.observe(time.perf_counter() - received, **{"class": kind})
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.tasks),
+            "capacity": ASGI_MAX_IN_FLIGHT,
+            "workers": ASGI_HANDLER_THREADS,
+            "api_pending": len(self.request.pending),
+        }
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=ASGI_DRAIN_TIMEOUT)
+        await self.request.drain(ASGI_DRAIN_TIMEOUT)
+        self.executor.shutdown(wait=True)
+        await self.client.aclose()
+
+runtime = None
+
+core.metrics.gauge("faba_asgi_in_flight", "Апдейты в обработке в ASGI-процессе",
+                   lambda: len(runtime.tasks) if runtime else 0)
+core.metrics.gauge("faba_asgi_api_pending", "Вызовы Bot API, ещё не получившие ответа",
+                   lambda: len(runtime.request.pending) if runtime else 0)
+
+# ==============================================================================
+# ASGI-ПРИЛОЖЕНИЕ
+# ==============================================================================
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def respond(send, status: int, body, content_type: str = "text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def lifespan(receive, send):
+    global runtime
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            runtime = AsgiRuntime()
+            await runtime.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if runtime:
+                await runtime.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    route = (scope["method"], scope["path"])
+
+    if route == ("POST", "/webhook"):
+        try:
+            data = json.loads(await read_body(receive))
+        except ValueError:
+            return await respond(send, 400, "Bad Request")
+        # Апдейт — JSON-объект с целым update_id; остальное не разбираем
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return await respond(send, 400, "Bad Request")
+        update_id = data["update_id"]
+        dedup = core.update_dedup
+        # С общим seen_updates проверка пишет в базу — не в цикле событий
+        if dedup.shared:
+            duplicate = await runtime.loop.run_in_executor(None, dedup.seen, update_id)
+        else:
+            duplicate = dedup.seen(update_id)
+        if duplicate:
+            core.UPDATES_DUPLICATE.inc()
+            return await respond(send, 200, "OK")
+        if not runtime.submit(data):
+            # 503 — Telegram повторит доставку, когда обработка разгрузится
+            if dedup.shared:
+                await runtime.loop.run_in_executor(None, dedup.forget, update_id)
+            else:
+                dedup.forget(update_id)
+            return await respond(send, 503, "Busy")
+        return await respond(send, 200, "OK")
+    if route == ("GET", "/queue"):
+        return await respond(send, 200, json.dumps(runtime.stats()), "application/json")
+    if route == ("GET", "/metrics"):
+        return await respond(send, 200, core.metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+    if route == ("GET", "/ping"):
+        return await respond(send, 200, "pong")
+    return await respond(send, 404, "Not Found")
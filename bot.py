@@ -2,22 +2,50 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import atexit
+import signal
 import logging
 import sqlite3
 import time
 import threading
+import heapq
+import json
+import csv
+import io
+import gzip
+import tempfile
+import pickle
+import functools
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from itertools import count, islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from math import floor, sqrt
 
 from flask import Flask, request
-from telegram import Bot, Update, ReplyKeyboardMarkup, ParseMode
+from telegram import (
+    Bot,
+    Message,
+    Update,
+    ReplyKeyboardMarkup,
+    ParseMode,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
 from telegram.ext import (
     Dispatcher,
-    CommandHandler,
     MessageHandler,
     Filters,
     CallbackContext,
 )
 from telegram.utils.request import Request
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TelegramError, Unauthorized
 
 # ==============================================================================
 # КОНСТАНТЫ
@@ -26,28 +54,10 @@ from telegram.utils.request import Request
 BOT_TOKEN   = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
-ALL_CITIES = [
-    {"name": "Тюмень",          "link": "https://t.me/+3AjZ_Eo2H-NjYWJi", "chat_id": -1002241413860},
-    {"name": "Новосибирск",     "link": "https://t.me/+wx20YVCwxmo3YmQy", "chat_id": -1002489311984},
-    {"name": "Сахалин",         "link": "https://t.me/+FzQ_jEYX8AtkMzNi", "chat_id": -1002265902434},
-    {"name": "Красноярск",      "link": "https://t.me/+lMTDVPF0syRiYzdi", "chat_id": -1002311750873},
-    {"name": "Санкт-Петербург", "link": "https://t.me/+EWj9jKhAvV82NWIy", "chat_id": -1002152780476},
-    {"name": "Москва",          "link": "https://t.me/+qokFNNnfhQdiYjQy", "chat_id": -1002182445604},
-    {"name": "Екатеринбург",    "link": "https://t.me/+J2ESyZJyOAk2YzYy", "chat_id": -1002392430562},
-    {"name": "Иркутск",         "link": "https://t.me/+TAoCnfoePUJmNzhi", "chat_id": -1002255012184},
-    {"name": "Оренбург",        "link": "https://t.me/+-Y_1N0HnePUxZjZi", "chat_id": -1002316600732},
-    {"name": "Крым",            "link": "https://t.me/+uC5IEnQWsmFhM2Ni", "chat_id": -1002506541314},
-    {"name": "Чита",            "link": "https://t.me/+yMeI0CjltLphZWYy", "chat_id": -1002563254789},
-    {"name": "Волгоград",       "link": "https://t.me/+ODxw0mfq73M4NGFi", "chat_id": -1002562049204},
-    {"name": "Краснодар",       "link": "https://t.me/+a9_1fWyGvAc1NzZi", "chat_id": -1002297851122},
-    {"name": "Пермь",           "link": "https://t.me/+lgM27u0cnp8wNjAy", "chat_id": -1002298810010},
-    {"name": "Самара",          "link": "https://t.me/+SLCllcYKCUFlNjk6", "chat_id": -1002589409715},
-    {"name": "Владивосток",     "link": "https://t.me/+Dpb3ozk_4Dc5OTYy", "chat_id": -1002438533236},
-    {"name": "Донецк",          "link": "https://t.me/+nGkS5gfvvQxjNmRi", "chat_id": -1002328107804},
-    {"name": "Хабаровск",       "link": "https://t.me/+SrnvRbMo3bA5NzVi", "chat_id": -1002480768813},
-    {"name": "Челябинск",       "link": "https://t.me/+ZKXj5rmcmMw0MzQy", "chat_id": -1002374636424},
-    {"name": "Тула",            "link": "https://t.me/+ZCq3GsGagIQ1NzRi", "chat_id": -1002678281080},
-]
+# Города и их чаты — в cities.json (name, link, chat_id, aliases). Файл
+# перечитывается при изменении раз в CITIES_RELOAD_INTERVAL секунд и по /cities reload
+CITIES_PATH            = os.getenv("CITIES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cities.json"))
+CITIES_RELOAD_INTERVAL = float(os.getenv("CITIES_RELOAD_INTERVAL", "30"))  # 0 — только командой
 
 TEST_SEND_CHATS = [
     -1002596576819,  # Москва тест
@@ -68,9 +78,301 @@ ALLOWED_USER_IDS = {
 XP_PER_MESSAGE    = 1
 XP_PER_50_CHARS   = 0.2
 XP_MAX_BONUS      = 4
-XP_CAP_PER_MINUTE = 5
+XP_CAP_PER_MINUTE = float(os.getenv("XP_CAP_PER_MINUTE", "5"))  # XP за скользящее окно
+
+# Ограничитель XP в памяти: окно, и сколько пар (chat_id, user_id) отслеживаем.
+# Окно своё у каждого воркера: сообщения пользователя расходятся по воркерам,
+# и за окно он может набрать до WEB_CONCURRENCY × XP_CAP_PER_MINUTE
+XP_WINDOW_SECONDS    = float(os.getenv("XP_WINDOW_SECONDS", "60"))
+XP_LIMITER_MAX_USERS = int(os.getenv("XP_LIMITER_MAX_USERS", "100000"))
+
+DB_PATH = os.getenv("DB_PATH", "activity.db")
+
+# Корзины XP по периодам: граница суток по местному времени, сроки хранения
+BUCKET_TZ_OFFSET        = float(os.getenv("BUCKET_TZ_OFFSET", "3"))          # часы от UTC
+ROLLUP_DAY_RETENTION    = int(os.getenv("ROLLUP_DAY_RETENTION", "14"))       # дней
+ROLLUP_WEEK_RETENTION   = int(os.getenv("ROLLUP_WEEK_RETENTION", "180"))     # дней
+ROLLUP_COMPACT_INTERVAL = float(os.getenv("ROLLUP_COMPACT_INTERVAL", "3600"))  # секунды
+
+# Параметры соединений SQLite (у каждого рабочего потока — своё долгоживущее)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS  = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE    = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))  # байты
+SQLITE_CACHE_SIZE   = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))  # < 0 — размер в КиБ
+SQLITE_STMT_CACHE   = int(os.getenv("SQLITE_STMT_CACHE", "128"))     # подготовленных запросов
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))  # секунды
+
+# Где хранится XP: sqlite — в DB_PATH; memory — в памяти процесса со снимком
+# на диск раз в MEMORY_SNAPSHOT_INTERVAL секунд (при падении теряется хвост)
+STORAGE_BACKEND          = os.getenv("STORAGE_BACKEND", "sqlite")   # sqlite | memory
+MEMORY_SNAPSHOT_PATH     = os.getenv("MEMORY_SNAPSHOT_PATH", "activity.snapshot")  # пусто — без снимков
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", "60"))
+
+# Отложенная запись XP: дельты копятся в памяти и сбрасываются пачкой
+XP_FLUSH_INTERVAL = float(os.getenv("XP_FLUSH_INTERVAL", "2"))   # секунды
+XP_FLUSH_BATCH    = int(os.getenv("XP_FLUSH_BATCH", "500"))      # пар (chat_id, user_id)
+# Последние известные имена: запись в users только при смене имени
+USER_NAME_CACHE_SIZE = int(os.getenv("USER_NAME_CACHE_SIZE", "100000"))
+
+# Снимки базы через online backup API: страниц за шаг и пауза между шагами,
+# чтобы писатели успевали между ними; периодические копии с ротацией
+BACKUP_PAGES      = int(os.getenv("BACKUP_PAGES", "1024"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))   # секунды
+BACKUP_DIR        = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL   = float(os.getenv("BACKUP_INTERVAL", "0"))        # секунды; 0 — без копий по расписанию
+BACKUP_KEEP       = int(os.getenv("BACKUP_KEEP", "7"))              # сколько последних копий хранить
+
+# Обслуживание базы раз в сутки в тихий час (по местному времени BUCKET_TZ_OFFSET):
+# архив неактивных с малым XP, incremental_vacuum шагами, ANALYZE и checkpoint WAL
+MAINTENANCE_HOUR           = int(os.getenv("MAINTENANCE_HOUR", "4"))              # -1 — только по /maintenance
+MAINTENANCE_CHECK_INTERVAL = float(os.getenv("MAINTENANCE_CHECK_INTERVAL", "300"))  # секунды
+ARCHIVE_INACTIVE_DAYS      = int(os.getenv("ARCHIVE_INACTIVE_DAYS", "365"))       # 0 — не архивировать
+ARCHIVE_MAX_XP             = float(os.getenv("ARCHIVE_MAX_XP", "10"))             # архивируем только меньше
+ARCHIVE_BATCH              = 500                                                  # пользователей за транзакцию
+VACUUM_STEP_PAGES          = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+VACUUM_STEP_SLEEP          = float(os.getenv("VACUUM_STEP_SLEEP", "0.05"))        # секунды
+
+# Выгрузка xp: строк за одно чтение из курсора; предел /dbdump (лимит длины сообщения)
+EXPORT_CHUNK_ROWS = 1000
+DBDUMP_MAX_ROWS   = 50
+
+# Сколько лучших держим в памяти для /top (это же и максимум N в /top)
+LEADERBOARD_TOP_K = 50
+# Сколько готовых текстов /top и списка чатов держим в LRU-кэше
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+
+# Установка webhook: auto — один раз на развёртывание (первый воркер),
+# off — только командой `python bot.py set-webhook`
+WEBHOOK_SETUP        = os.getenv("WEBHOOK_SETUP", "auto")
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+# Идентификатор развёртывания; без него — мастер gunicorn (общий родитель
+# воркеров) и время его запуска, см. deploy_id()
+DEPLOY_ID            = os.getenv("DEPLOY_ID")
+# Число воркеров gunicorn (он читает ту же переменную): от него зависят
+# умолчания для состояния, которое воркеры делят через базу
+WEB_CONCURRENCY      = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Рейтинг в памяти каждого процесса догружается из базы с этим интервалом
+# (секунды), чтобы при нескольких воркерах /top и /rank видели XP, записанный
+# соседями; читаются только строки xp, изменённые с прошлой догрузки.
+# По умолчанию включено, лишь если gunicorn запущен с несколькими воркерами
+# (WEB_CONCURRENCY); 0 — выключено. Для STORAGE_BACKEND=memory не действует:
+# там у каждого процесса своё хранилище
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv(
+    "LEADERBOARD_REFRESH_INTERVAL", "30" if WEB_CONCURRENCY > 1 else "0"
+))
+
+# Пул обработки входящих апдейтов
+WEBHOOK_WORKERS       = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE    = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_QUEUE_POLICY  = os.getenv("WEBHOOK_QUEUE_POLICY", "delay")      # drop | delay
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", "5"))  # секунды ожидания при delay
+# Сообщения групп (только XP) стоят в своей очереди; при её переполнении XP
+# засчитывается сразу, минуя Dispatcher (coalesce), или сообщение отбрасывается (shed)
+WEBHOOK_PASSIVE_QUEUE_SIZE = int(os.getenv("WEBHOOK_PASSIVE_QUEUE_SIZE", "500"))
+WEBHOOK_PASSIVE_OVERLOAD   = os.getenv("WEBHOOK_PASSIVE_OVERLOAD", "coalesce")  # coalesce | shed
+
+# Медленные апдейты: порог обработки (секунды) и сколько последних держим для /slow
+SLOW_UPDATE_SECONDS  = float(os.getenv("SLOW_UPDATE_SECONDS", "0.5"))
+SLOW_UPDATE_LOG_SIZE = int(os.getenv("SLOW_UPDATE_LOG_SIZE", "100"))
+# /profile: предел окна (секунды) и шаг снятия стеков всех потоков
+PROFILE_MAX_SECONDS     = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# Повторные доставки: сколько последних update_id помним и сохранять ли их в базу,
+# чтобы дубли отсекались и после перезапуска
+UPDATE_DEDUP_SIZE           = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_PERSIST        = os.getenv("UPDATE_DEDUP_PERSIST", "1") == "1"
+# Новый для этого процесса id сразу записывается в seen_updates, и дублем он
+# считается, если его уже записал соседний воркер; по умолчанию — при нескольких воркерах
+UPDATE_DEDUP_SHARED         = UPDATE_DEDUP_PERSIST and os.getenv(
+    "UPDATE_DEDUP_SHARED", "1" if WEB_CONCURRENCY > 1 else "0") == "1"
+UPDATE_DEDUP_FLUSH_INTERVAL = float(os.getenv("UPDATE_DEDUP_FLUSH_INTERVAL", "2"))  # секунды
+
+# Рассылка: параллельность и лимиты Bot API
+BROADCAST_WORKERS     = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))     # сообщений/с на бота
+BROADCAST_CHAT_RATE   = float(os.getenv("BROADCAST_CHAT_RATE", str(20 / 60)))  # сообщений/с в группу
+BROADCAST_CHAT_BURST  = int(os.getenv("BROADCAST_CHAT_BURST", "5"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "5"))
+# При остановке: сколько ждать, пока идущие рассылки допишут отправки в полёте
+# и пришлют администратору отчёт о частичной доставке (секунды)
+BROADCAST_SHUTDOWN_TIMEOUT = float(os.getenv("BROADCAST_SHUTDOWN_TIMEOUT", "10"))
 
-DB_PATH = "activity.db"
+# ==============================================================================
+# МЕТРИКИ (Prometheus, без внешних зависимостей)
+# ==============================================================================
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.kind = "counter"
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list:
+        with self._lock:
+            return [f"{self.name}{format_labels(key)} {value}" for key, value in self._values.items()]
+
+class Gauge(Counter):
+    # С func значение (или словарь метки → значение) снимается при запросе
+    # /metrics; kind="counter" — для счётчиков, которые ведёт сам объект
+    def __init__(self, name: str, help_text: str, func=None, kind: str = "gauge"):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self._func = func
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list:
+        if self._func is None:
+            return super().render()
+        value = self._func()
+        values = value if isinstance(value, dict) else {(): value}
+        return [f"{self.name}{format_labels(key)} {v}" for key, v in values.items()]
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.kind = "histogram"
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        # Храним попадания по корзинам, накопительные суммы — только при выдаче
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = []
+        with self._lock:
+            series = [(key, list(counts), total, n) for key, (counts, total, n) in self._series.items()]
+        for key, counts, total, n in series:
+            cumulative = 0
+            for bound, hits in zip(self.buckets, counts):
+                cumulative += hits
+                le = format_labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = format_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {n}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {n}")
+        return lines
+
+# Трасса апдейта, который сейчас обрабатывает поток: цепочка хэндлеров и
+# время в SQLite и Bot API. Вне обработки апдейта current = None.
+update_trace = threading.local()
+
+class TracedHistogram(Histogram):
+    # Кроме метрики, время копится в поле field трассы текущего апдейта
+    def __init__(self, name: str, help_text: str, field: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, buckets)
+        self.field = field
+
+    def observe(self, value: float, **labels):
+        super().observe(value, **labels)
+        trace = getattr(update_trace, "current", None)
+        if trace is not None:
+            trace[self.field] += value
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, func=None, kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help_text, func, kind))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HANDLER_SECONDS  = metrics.histogram("faba_handler_seconds", "Время работы хэндлера")
+HANDLER_ERRORS   = metrics.counter("faba_handler_errors_total", "Исключения в хэндлерах")
+SQLITE_SECONDS   = metrics.register(TracedHistogram("faba_sqlite_seconds", "Длительность операций SQLite по типу", "sqlite"))
+API_SECONDS      = metrics.register(TracedHistogram("faba_bot_api_seconds", "Длительность вызовов Bot API по методу", "api"))
+API_ERRORS       = metrics.counter("faba_bot_api_errors_total", "Ошибки Bot API по методу и типу")
+BROADCAST_SENT   = metrics.counter("faba_broadcast_messages_total", "Сообщения рассылки по результату")
+BROADCAST_QUEUED = metrics.counter("faba_broadcast_queued_messages_total", "Сообщения, поставленные в рассылку")
+
+def timed_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        trace = getattr(update_trace, "current", None)
+        if trace is not None:
+            trace["handlers"].append(name)
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+class InstrumentedRequest(Request):
+    # Время и ошибки каждого вызова Bot API, метка — имя метода из URL
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout)
+        except Exception as e:
+            API_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, method=method)
 
 # ==============================================================================
 # ИНИЦИАЛИЗАЦИЯ Flask И Dispatcher
@@ -80,7 +382,7 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-req = Request(
+req = InstrumentedRequest(
     connect_timeout=20,
     read_timeout=20
 )
@@ -91,10 +393,89 @@ dispatcher = Dispatcher(bot, None, workers=4, use_context=True)
 # ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ (SQLite)
 # ==============================================================================
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
+class Database:
+    # Одно долгоживущее соединение на поток: PRAGMA выставляются один раз,
+    # а кэш подготовленных запросов sqlite3 (cached_statements) переживает
+    # вызовы хэндлеров, так что горячие запросы не разбираются заново.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_STMT_CACHE,
+            check_same_thread=False,
+        )
+        # До journal_mode: переход в WAL создаёт файл, и на новой базе режим
+        # уже не сменить без VACUUM. На существующей прагма ничего не меняет —
+        # её переводит обслуживание базы
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._close_dead()
+                self._conns[threading.current_thread()] = conn
+        return conn
+
+    def _close_dead(self):
+        # Соединения завершившихся потоков закрываем сразу, а не ждём GC
+        for thread in [t for t in self._conns if not t.is_alive()]:
+            self._conns.pop(thread).close()
+
+    def query(self, sql: str, params: tuple = ()) -> list:
+        with SQLITE_SECONDS.time(op="query"):
+            return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params: tuple = ()):
+        with SQLITE_SECONDS.time(op="query"):
+            return self.connection().execute(sql, params).fetchone()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: в WAL это исключает
+        # SQLITE_BUSY при повышении читающей транзакции до пишущей
+        conn = self.connection()
+        with SQLITE_SECONDS.time(op="lock_wait"):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            with SQLITE_SECONDS.time(op="transaction"):
+                yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            with SQLITE_SECONDS.time(op="commit"):
+                conn.commit()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+        self._local = threading.local()
+
+db = Database(DB_PATH)
+
+# ==============================================================================
+# МИГРАЦИИ СХЕМЫ (PRAGMA user_version)
+# ==============================================================================
+
+def migration_1_xp(conn: sqlite3.Connection):
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS xp (
             chat_id     INTEGER     NOT NULL,
@@ -107,8 +488,253 @@ def init_db():
         )
         """
     )
-    conn.commit()
-    conn.close()
+
+def migration_2_user_totals(conn: sqlite3.Connection):
+    # Материализованные суммы по пользователю: глобальный топ и /rank
+    # без GROUP BY по всей таблице xp
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id      INTEGER     PRIMARY KEY,
+            total_xp     REAL        DEFAULT 0,
+            best_chat_id INTEGER     DEFAULT 0,
+            best_xp      REAL        DEFAULT 0,
+            first_name   TEXT        DEFAULT '',
+            last_name    TEXT        DEFAULT ''
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_totals_xp ON user_totals(total_xp DESC)"
+    )
+    has_totals = conn.execute("SELECT 1 FROM user_totals LIMIT 1").fetchone()
+    if not has_totals:
+        # Бэкфилл для существующей базы; голые столбцы при MAX() берутся
+        # из строки с максимальным total_xp — это и есть лучший город
+        conn.execute(
+            """
+            INSERT INTO user_totals (user_id, total_xp, best_chat_id, best_xp, first_name, last_name)
+            SELECT user_id, SUM(total_xp), chat_id, MAX(total_xp), first_name, last_name
+              FROM xp
+             GROUP BY user_id
+            """
+        )
+
+def migration_3_xp_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_xp_user ON xp(user_id)")
+    # Покрывающий индекс для топа по городу: без сортировки и без чтения строк
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_xp_chat_xp ON xp(chat_id, total_xp DESC, user_id)"
+    )
+
+def migration_4_xp_rollup(conn: sqlite3.Connection):
+    # grain: d — сутки, w — неделя (с понедельника), m — месяц; bucket — начало
+    # периода (unix-время). chat_id = 0 — сумма пользователя по всем городам.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS xp_rollup (
+            grain       TEXT        NOT NULL,
+            bucket      INTEGER     NOT NULL,
+            chat_id     INTEGER     NOT NULL,
+            user_id     INTEGER     NOT NULL,
+            xp          REAL        DEFAULT 0,
+            PRIMARY KEY(grain, bucket, chat_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_xp_rollup_top ON xp_rollup(grain, bucket, chat_id, xp DESC)"
+    )
+
+def migration_5_shared_state(conn: sqlite3.Connection):
+    # Состояние, общее для всех воркеров: сессии рассылки и служебные ключи
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_sessions (
+            user_id     INTEGER     PRIMARY KEY,
+            mode        TEXT,
+            waiting     INTEGER     DEFAULT 0,
+            updated_ts  INTEGER     DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_buffer (
+            id          INTEGER     PRIMARY KEY AUTOINCREMENT,
+            user_id     INTEGER     NOT NULL,
+            message     TEXT        NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_buffer_user ON broadcast_buffer(user_id, id)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key         TEXT        PRIMARY KEY,
+            value       TEXT
+        )
+        """
+    )
+
+def migration_6_seen_updates(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            update_id   INTEGER     PRIMARY KEY,
+            seen_ts     INTEGER     NOT NULL
+        )
+        """
+    )
+
+def migration_7_users(conn: sqlite3.Connection):
+    # Имена — в отдельной таблице users и пишутся только при смене; в xp и
+    # user_totals остаются одни числа
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id     INTEGER     PRIMARY KEY,
+            first_name  TEXT        DEFAULT '',
+            last_name   TEXT        DEFAULT ''
+        )
+        """
+    )
+    # Самое свежее имя — из строки xp с последним сообщением (голые столбцы при MAX)
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO users (user_id, first_name, last_name)
+        SELECT user_id, first_name, last_name
+          FROM (SELECT user_id, first_name, last_name, MAX(last_msg_ts) FROM xp GROUP BY user_id)
+        """
+    )
+
+    conn.execute(
+        """
+        CREATE TABLE xp_new (
+            chat_id     INTEGER     NOT NULL,
+            user_id     INTEGER     NOT NULL,
+            total_xp    REAL        DEFAULT 0,
+            last_msg_ts INTEGER     DEFAULT 0,
+            PRIMARY KEY(chat_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        "INSERT INTO xp_new (chat_id, user_id, total_xp, last_msg_ts) "
+        "SELECT chat_id, user_id, total_xp, last_msg_ts FROM xp"
+    )
+    conn.execute("DROP TABLE xp")
+    conn.execute("ALTER TABLE xp_new RENAME TO xp")
+    migration_3_xp_indexes(conn)
+
+    conn.execute(
+        """
+        CREATE TABLE user_totals_new (
+            user_id      INTEGER     PRIMARY KEY,
+            total_xp     REAL        DEFAULT 0,
+            best_chat_id INTEGER     DEFAULT 0,
+            best_xp      REAL        DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        "INSERT INTO user_totals_new (user_id, total_xp, best_chat_id, best_xp) "
+        "SELECT user_id, total_xp, best_chat_id, best_xp FROM user_totals"
+    )
+    conn.execute("DROP TABLE user_totals")
+    conn.execute("ALTER TABLE user_totals_new RENAME TO user_totals")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_totals_xp ON user_totals(total_xp DESC)"
+    )
+
+def migration_8_xp_archive(conn: sqlite3.Connection):
+    # Холодные строки xp: пользователи, давно не писавшие и набравшие мало XP.
+    # Из рейтингов и user_totals они убраны, но выгрузить их можно отсюда.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS xp_archive (
+            chat_id     INTEGER     NOT NULL,
+            user_id     INTEGER     NOT NULL,
+            total_xp    REAL        DEFAULT 0,
+            last_msg_ts INTEGER     DEFAULT 0,
+            archived_ts INTEGER     NOT NULL,
+            PRIMARY KEY(chat_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+def migration_9_user_totals_slim(conn: sqlite3.Connection):
+    # best_chat_id и best_xp никто не читает: лучший город глобального топа
+    # считает рейтинг в памяти. Без них upsert суммы не лезет подзапросом в xp
+    conn.execute(
+        """
+        CREATE TABLE user_totals_new (
+            user_id      INTEGER     PRIMARY KEY,
+            total_xp     REAL        DEFAULT 0
+        )
+        """
+    )
+    conn.execute("INSERT INTO user_totals_new (user_id, total_xp) SELECT user_id, total_xp FROM user_totals")
+    conn.execute("DROP TABLE user_totals")
+    conn.execute("ALTER TABLE user_totals_new RENAME TO user_totals")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_totals_xp ON user_totals(total_xp DESC)"
+    )
+
+# Номера только растут; применённую миграцию не меняем — добавляем новую
+MIGRATIONS = [
+    (1, "таблица xp", migration_1_xp),
+    (2, "материализованные суммы user_totals", migration_2_user_totals),
+    (3, "индексы xp(user_id) и xp(chat_id, total_xp DESC)", migration_3_xp_indexes),
+    (4, "корзины XP по дням, неделям и месяцам", migration_4_xp_rollup),
+    (5, "сессии рассылки и служебные ключи", migration_5_shared_state),
+    (6, "недавние update_id для отсева повторов", migration_6_seen_updates),
+    (7, "имена в users, в xp и user_totals только числа", migration_7_users),
+    (8, "архив неактивных xp_archive", migration_8_xp_archive),
+    (9, "user_totals без best_chat_id и best_xp", migration_9_user_totals_slim),
+]
+
+MIGRATION_BACKUP = os.getenv("MIGRATION_BACKUP", "1") == "1"
+
+def schema_version(database: Database) -> int:
+    return database.query_one("PRAGMA user_version")[0]
+
+def backup_before_migration(database: Database, version: int):
+    # Копия рабочей базы через online backup API, пока ничего не изменено
+    has_data = database.query_one(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'xp'"
+    )
+    if not has_data:
+        return
+    backup_path = f"{database.path}.v{version}.bak"
+    target = sqlite3.connect(backup_path)
+    try:
+        database.connection().backup(target)
+    finally:
+        target.close()
+    logger.info(f"Резервная копия перед миграцией: {backup_path}")
+
+def run_migrations(database: Database):
+    current = schema_version(database)
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        return
+    if MIGRATION_BACKUP:
+        backup_before_migration(database, current)
+
+    for version, description, apply in pending:
+        with database.transaction() as conn:
+            # Другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            apply(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"Миграция {version} применена: {description}")
+
+def init_db():
+    run_migrations(db)
 
 init_db()
 
@@ -122,166 +748,1548 @@ def calc_message_xp(text: str) -> float:
     return base + length_bonus
 
 def get_city_name(chat_id: int) -> str:
-    for city in ALL_CITIES:
-        if city["chat_id"] == chat_id:
-            return city["name"]
-    return "Неизвестно"
+    return cities.name(chat_id)
+
+# ==============================================================================
+# РЕЕСТР ГОРОДОВ (cities.json)
+# ==============================================================================
+
+def normalize_city(text: str) -> str:
+    return " ".join(text.lower().replace("ё", "е").split())
+
+class CityIndex:
+    # Неизменяемый снимок конфига: все индексы строятся один раз при загрузке
+    def __init__(self, entries: list, mtime: float):
+        self.mtime = mtime
+        self.cities = tuple(
+            {"name": c["name"], "link": c["link"], "chat_id": int(c["chat_id"])} for c in entries
+        )
+        self.by_chat = {c["chat_id"]: c for c in self.cities}
+        self.chat_ids = frozenset(self.by_chat)
+        by_name = {}
+        for entry, city in zip(entries, self.cities):
+            for key in [city["name"], *entry.get("aliases", ())]:
+                key = normalize_city(key)
+                if by_name.get(key, city["chat_id"]) != city["chat_id"]:
+                    raise ValueError(f"Имя «{key}» указано у двух городов")
+                by_name[key] = city["chat_id"]
+        self.by_name = by_name
+        if len(self.by_chat) != len(self.cities):
+            raise ValueError("Повторяющийся chat_id в списке городов")
+
+class CityRegistry:
+    # Читатели берут текущий CityIndex одной ссылкой; перезагрузка строит
+    # новый индекс целиком и подменяет ссылку, так что полузагруженного
+    # состояния никто не видит. Слушатели узнают о смене набора чатов.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = self._read()
+        self._failed_mtime = None
+        self.version = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def _read(self) -> CityIndex:
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, encoding="utf-8") as f:
+            return CityIndex(json.load(f), mtime)
+
+    def all(self) -> tuple:
+        return self._index.cities
+
+    @property
+    def chat_ids(self) -> frozenset:
+        return self._index.chat_ids
+
+    def name(self, chat_id: int) -> str:
+        city = self._index.by_chat.get(chat_id)
+        return city["name"] if city else "Неизвестно"
+
+    def find(self, text: str):
+        # chat_id по названию или псевдониму, без учёта регистра и «ё»
+        return self._index.by_name.get(normalize_city(text))
+
+    def names(self) -> str:
+        return ", ".join(city["name"] for city in self._index.cities)
+
+    def on_reload(self, callback):
+        self._listeners.append(callback)
+
+    def reload(self, force: bool = False) -> bool:
+        # True, если список городов перечитан
+        with self._lock:
+            mtime = os.path.getmtime(self.path)
+            if not force and mtime in (self._index.mtime, self._failed_mtime):
+                return False
+            try:
+                index = self._read()
+            except Exception:
+                # Битый файл не перечитываем по кругу — ждём следующей правки
+                self._failed_mtime = mtime
+                raise
+            self._index = index
+            self.version += 1
+        for callback in self._listeners:
+            callback(index)
+        logger.info(f"Список городов перечитан: {len(index.cities)}")
+        return True
+
+cities = CityRegistry(CITIES_PATH)
+
+# ==============================================================================
+# ПЕРИОДЫ: КОРЗИНЫ XP ПО ДНЯМ, НЕДЕЛЯМ И МЕСЯЦАМ
+# ==============================================================================
+
+BUCKET_TZ = timezone(timedelta(hours=BUCKET_TZ_OFFSET))
+
+PERIOD_GRAINS = {"день": "d", "сегодня": "d", "неделя": "w", "месяц": "m"}
+PERIOD_TITLES = {"d": "за сегодня", "w": "за неделю", "m": "за месяц"}
+
+def period_start(grain: str, ts: float) -> int:
+    day = datetime.fromtimestamp(ts, BUCKET_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    if grain == "w":
+        day -= timedelta(days=day.weekday())
+    elif grain == "m":
+        day = day.replace(day=1)
+    return int(day.timestamp())
+
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO xp_rollup (grain, bucket, chat_id, user_id, xp)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(grain, bucket, chat_id, user_id) DO UPDATE SET
+        xp = xp_rollup.xp + excluded.xp
+"""
+
+def rollup_rows(batch: dict) -> list:
+    # Дневные дельты сворачиваются в корзины всех трёх периодов — по городу
+    # и по сумме городов (chat_id = 0) — ещё до записи, одной строкой на ключ
+    rollups = {}
+    for (chat_id, user_id, day), entry in batch.items():
+        xp = entry[0]
+        for grain in ("d", "w", "m"):
+            bucket = day if grain == "d" else period_start(grain, day)
+            for scope in (chat_id, 0):
+                key = (grain, bucket, scope, user_id)
+                rollups[key] = rollups.get(key, 0.0) + xp
+    return [key + (xp,) for key, xp in rollups.items()]
+
+def compact_rollups(store, now: float):
+    # Недельные и месячные корзины пополняются вместе с дневными, поэтому
+    # старые дни уже слиты в более крупные периоды и их можно удалять
+    day_bound = period_start("d", now - ROLLUP_DAY_RETENTION * 86400)
+    week_bound = period_start("w", now - ROLLUP_WEEK_RETENTION * 86400)
+    store.compact_rollups(day_bound, week_bound)
+
+class PeriodicTask:
+    def __init__(self, name: str, interval: float, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception as e:
+                logger.error(f"Фоновая задача {self.name} завершилась с ошибкой: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+# ==============================================================================
+# ХРАНИЛИЩЕ XP (SQLite или память)
+# ==============================================================================
+
+class XpStorage(ABC):
+    # Всё, что пишет XpWriteBehind и читают рейтинги, /rank и выгрузка.
+    # Служебные таблицы (сессии рассылки, meta, seen_updates) всегда в SQLite.
+
+    @abstractmethod
+    def add_batch(self, batch: dict, names: dict) -> int:
+        # batch: {(chat_id, user_id, сутки): [xp, ts]}, names: {user_id: (first_name, last_name)}
+        # только для сменившихся имён; возвращает число записанных пар (chat_id, user_id)
+        ...
+
+    @abstractmethod
+    def top(self, chat_id, n: int) -> list:
+        # [(user_id, xp)] по убыванию; chat_id=None — суммы по всем городам
+        ...
+
+    @abstractmethod
+    def user_xp(self, chat_id, user_id: int):
+        # (xp, first_name, last_name) или None; chat_id=None — сумма
+        ...
+
+    @abstractmethod
+    def iter_xp(self, chat_id=None, min_xp: float = 0):
+        # (chat_id, user_id, first_name, last_name, total_xp, last_msg_ts)
+        ...
+
+    @abstractmethod
+    def iter_totals(self):
+        # (user_id, total_xp, first_name, last_name)
+        ...
+
+    @abstractmethod
+    def changed_since(self, since_ts: int) -> tuple:
+        # Строки с сообщениями не раньше since_ts: ([(chat_id, user_id, total_xp)],
+        # [(user_id, total_xp, first_name, last_name)] для тех же пользователей)
+        ...
+
+    @abstractmethod
+    def period_top(self, grain: str, bucket: int, scope: int, n: int) -> list:
+        # [(user_id, xp)] корзины периода; scope 0 — все города
+        ...
+
+    @abstractmethod
+    def period_cities(self, grain: str, bucket: int, user_ids: list) -> list:
+        # [(chat_id, user_id, xp)] по городам для данных пользователей
+        ...
+
+    @abstractmethod
+    def period_user(self, grain: str, bucket: int, scope: int, user_id: int) -> tuple:
+        # (xp или None, сколько набрали не меньше floor(xp) + 1, всего в корзине)
+        ...
+
+    @abstractmethod
+    def compact_rollups(self, day_bound: int, week_bound: int):
+        ...
+
+    @abstractmethod
+    def archive_inactive(self, before_ts: int, max_xp: float, archived_ts: int) -> int:
+        # Переносит в архив пользователей без сообщений с before_ts и с суммой
+        # меньше max_xp; возвращает их число
+        ...
+
+    def close(self):
+        pass
+
+XP_UPSERT_SQL = """
+    INSERT INTO xp (chat_id, user_id, total_xp, last_msg_ts)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        total_xp    = xp.total_xp + excluded.total_xp,
+        last_msg_ts = MAX(xp.last_msg_ts, excluded.last_msg_ts)
+"""
+
+USER_TOTALS_UPSERT_SQL = """
+    INSERT INTO user_totals (user_id, total_xp)
+    VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        total_xp = user_totals.total_xp + excluded.total_xp
+"""
+
+USERS_UPSERT_SQL = """
+    INSERT INTO users (user_id, first_name, last_name)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        first_name = excluded.first_name,
+        last_name  = excluded.last_name
+"""
+
+# /rank: XP и имя одним запросом с join вместо отдельного поиска имени
+USER_TOTAL_SQL = (
+    "SELECT t.total_xp, IFNULL(u.first_name, ''), IFNULL(u.last_name, '') "
+    "FROM user_totals t LEFT JOIN users u ON u.user_id = t.user_id WHERE t.user_id = ?"
+)
+USER_CITY_XP_SQL = (
+    "SELECT x.total_xp, IFNULL(u.first_name, ''), IFNULL(u.last_name, '') "
+    "FROM xp x LEFT JOIN users u ON u.user_id = x.user_id WHERE x.chat_id = ? AND x.user_id = ?"
+)
+
+ARCHIVE_CANDIDATES_SQL = """
+    SELECT t.user_id FROM user_totals t
+     WHERE t.total_xp < ?
+       AND NOT EXISTS (SELECT 1 FROM xp WHERE xp.user_id = t.user_id AND xp.last_msg_ts >= ?)
+"""
+
+ARCHIVE_MOVE_SQL = """
+    INSERT INTO xp_archive (chat_id, user_id, total_xp, last_msg_ts, archived_ts)
+    SELECT chat_id, user_id, total_xp, last_msg_ts, ? FROM xp WHERE user_id IN ({})
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        total_xp    = xp_archive.total_xp + excluded.total_xp,
+        last_msg_ts = MAX(xp_archive.last_msg_ts, excluded.last_msg_ts),
+        archived_ts = excluded.archived_ts
+"""
+
+class SqliteStorage(XpStorage):
+    def __init__(self, database: Database):
+        self.db = database
+
+    def add_batch(self, batch: dict, names: dict) -> int:
+        merged = {}
+        for (chat_id, user_id, day), (xp, ts) in batch.items():
+            entry = merged.get((chat_id, user_id))
+            if entry:
+                entry[0] += xp
+                entry[1] = max(entry[1], ts)
+            else:
+                merged[(chat_id, user_id)] = [xp, ts]
+
+        rows = [(chat_id, user_id, xp, ts) for (chat_id, user_id), (xp, ts) in merged.items()]
+        totals = {}
+        for chat_id, user_id, xp, ts in rows:
+            totals[user_id] = totals.get(user_id, 0.0) + xp
+        with self.db.transaction() as conn:
+            conn.executemany(XP_UPSERT_SQL, rows)
+            conn.executemany(USER_TOTALS_UPSERT_SQL, totals.items())
+            conn.executemany(ROLLUP_UPSERT_SQL, rollup_rows(batch))
+            if names:
+                conn.executemany(
+                    USERS_UPSERT_SQL,
+                    [(user_id, first_name, last_name) for user_id, (first_name, last_name) in names.items()]
+                )
+        return len(rows)
+
+    def top(self, chat_id, n: int) -> list:
+        if chat_id is None:
+            return self.db.query("SELECT user_id, total_xp FROM user_totals ORDER BY total_xp DESC LIMIT ?", (n,))
+        return self.db.query(
+            "SELECT user_id, total_xp FROM xp WHERE chat_id = ? ORDER BY total_xp DESC LIMIT ?", (chat_id, n)
+        )
+
+    def user_xp(self, chat_id, user_id: int):
+        if chat_id is None:
+            return self.db.query_one(USER_TOTAL_SQL, (user_id,))
+        return self.db.query_one(USER_CITY_XP_SQL, (chat_id, user_id))
+
+    def iter_xp(self, chat_id=None, min_xp: float = 0):
+        # Курсор читается порциями: в памяти не больше EXPORT_CHUNK_ROWS строк,
+        # а в WAL всё чтение идёт из одного снимка
+        sql = (
+            "SELECT x.chat_id, x.user_id, IFNULL(u.first_name, ''), IFNULL(u.last_name, ''), "
+            "x.total_xp, x.last_msg_ts FROM xp x LEFT JOIN users u ON u.user_id = x.user_id "
+            "WHERE x.total_xp >= ?"
+        )
+        params = [min_xp]
+        if chat_id is not None:
+            sql += " AND x.chat_id = ?"
+            params.append(chat_id)
+        cursor = self.db.connection().execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_totals(self):
+        return self.db.query(
+            "SELECT t.user_id, t.total_xp, IFNULL(u.first_name, ''), IFNULL(u.last_name, '') "
+            "FROM user_totals t LEFT JOIN users u ON u.user_id = t.user_id"
+        )
+
+    def changed_since(self, since_ts: int) -> tuple:
+        # Оба запроса в одной читающей транзакции — из одного снимка WAL
+        conn = self.db.connection()
+        with SQLITE_SECONDS.time(op="query"):
+            conn.execute("BEGIN")
+            try:
+                xp_rows = conn.execute(
+                    "SELECT chat_id, user_id, total_xp FROM xp WHERE last_msg_ts >= ?", (since_ts,)
+                ).fetchall()
+                totals = conn.execute(
+                    "SELECT t.user_id, t.total_xp, IFNULL(u.first_name, ''), IFNULL(u.last_name, '') "
+                    "FROM user_totals t LEFT JOIN users u ON u.user_id = t.user_id "
+                    "WHERE t.user_id IN (SELECT user_id FROM xp WHERE last_msg_ts >= ?)", (since_ts,)
+                ).fetchall()
+            finally:
+                conn.commit()
+        return xp_rows, totals
+
+    def period_top(self, grain: str, bucket: int, scope: int, n: int) -> list:
+        return self.db.query(
+            "SELECT user_id, xp FROM xp_rollup "
+            "WHERE grain = ? AND bucket = ? AND chat_id = ? ORDER BY xp DESC LIMIT ?",
+            (grain, bucket, scope, n)
+        )
+
+    def period_cities(self, grain: str, bucket: int, user_ids: list) -> list:
+        placeholders = ",".join("?" * len(user_ids))
+        return self.db.query(
+            "SELECT chat_id, user_id, xp FROM xp_rollup "
+            f"WHERE grain = ? AND bucket = ? AND chat_id != 0 AND user_id IN ({placeholders})",
+            (grain, bucket, *user_ids)
+        )
+
+    def period_user(self, grain: str, bucket: int, scope: int, user_id: int) -> tuple:
+        row = self.db.query_one(
+            "SELECT xp FROM xp_rollup WHERE grain = ? AND bucket = ? AND chat_id = ? AND user_id = ?",
+            (grain, bucket, scope, user_id)
+        )
+        count = self.db.query_one(
+            "SELECT COUNT(*) FROM xp_rollup WHERE grain = ? AND bucket = ? AND chat_id = ?",
+            (grain, bucket, scope)
+        )[0]
+        if not row:
+            return None, 0, count
+        above = self.db.query_one(
+            "SELECT COUNT(*) FROM xp_rollup WHERE grain = ? AND bucket = ? AND chat_id = ? AND xp >= ?",
+            (grain, bucket, scope, floor(row[0]) + 1)
+        )[0]
+        return row[0], above, count
+
+    def compact_rollups(self, day_bound: int, week_bound: int):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM xp_rollup WHERE grain = 'd' AND bucket < ?", (day_bound,))
+            conn.execute("DELETE FROM xp_rollup WHERE grain = 'w' AND bucket < ?", (week_bound,))
+
+    def archive_inactive(self, before_ts: int, max_xp: float, archived_ts: int) -> int:
+        # Кандидаты выбираются без блокировки записи, перенос — короткими
+        # транзакциями по ARCHIVE_BATCH; внутри условие проверяется заново,
+        # на случай если пользователь успел написать
+        candidates = [row[0] for row in self.db.query(ARCHIVE_CANDIDATES_SQL, (max_xp, before_ts))]
+        archived = 0
+        for start in range(0, len(candidates), ARCHIVE_BATCH):
+            chunk = candidates[start:start + ARCHIVE_BATCH]
+            with self.db.transaction() as conn:
+                placeholders = ",".join("?" * len(chunk))
+                user_ids = [row[0] for row in conn.execute(
+                    f"{ARCHIVE_CANDIDATES_SQL} AND t.user_id IN ({placeholders})", (max_xp, before_ts, *chunk)
+                )]
+                if not user_ids:
+                    continue
+                placeholders = ",".join("?" * len(user_ids))
+                conn.execute(ARCHIVE_MOVE_SQL.format(placeholders), (archived_ts, *user_ids))
+                conn.execute(f"DELETE FROM xp WHERE user_id IN ({placeholders})", user_ids)
+                conn.execute(f"DELETE FROM user_totals WHERE user_id IN ({placeholders})", user_ids)
+            archived += len(user_ids)
+        return archived
+
+class SortedScores:
+    # Очки одной области по возрастанию в списке пар (xp, user_id): вставка
+    # и удаление через bisect, топ — срез с конца, место — бинарный поиск
+    def __init__(self):
+        self._items = []
+        self._scores = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, user_id: int):
+        return self._scores.get(user_id)
+
+    def add(self, user_id: int, delta: float) -> float:
+        old = self._scores.get(user_id)
+        if old is not None:
+            del self._items[bisect_left(self._items, (old, user_id))]
+        xp = (old or 0.0) + delta
+        self._scores[user_id] = xp
+        insort(self._items, (xp, user_id))
+        return xp
+
+    def remove(self, user_id: int):
+        xp = self._scores.pop(user_id, None)
+        if xp is not None:
+            del self._items[bisect_left(self._items, (xp, user_id))]
+
+    def top(self, n: int) -> list:
+        return [(user_id, xp) for xp, user_id in reversed(self._items[-n:])] if n > 0 else []
+
+    def count_at_least(self, xp: float) -> int:
+        return len(self._items) - bisect_left(self._items, (xp, float("-inf")))
+
+    def items(self):
+        return self._scores.items()
+
+class MemoryStorage(XpStorage):
+    # Те же данные, что в таблицах xp, user_totals и xp_rollup, но в словарях
+    # и SortedScores. Снимок на диск — pickle, записанный атомарно через
+    # временный файл; при старте поднимается из него.
+
+    def __init__(self, snapshot_path: str = None):
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._xp = {}        # (chat_id, user_id) -> [xp, last_msg_ts]
+        self._totals = {}    # user_id -> [xp]
+        self._names = {}     # user_id -> (first_name, last_name)
+        self._scores = {}    # chat_id (None — все города) -> SortedScores
+        self._rollup = {}    # (grain, bucket, scope) -> SortedScores
+        self._archive = {}   # (chat_id, user_id) -> [xp, last_msg_ts, archived_ts]
+        self._dirty = False
+        if snapshot_path and os.path.exists(snapshot_path):
+            self._restore()
+
+    def _scope(self, chat_id) -> SortedScores:
+        scores = self._scores.get(chat_id)
+        if scores is None:
+            scores = self._scores[chat_id] = SortedScores()
+        return scores
+
+    def _apply(self, chat_id: int, user_id: int, xp: float, ts: int):
+        entry = self._xp.get((chat_id, user_id))
+        if entry:
+            entry[1] = max(entry[1], ts)
+        else:
+            self._xp[(chat_id, user_id)] = entry = [0.0, ts]
+        entry[0] = self._scope(chat_id).add(user_id, xp)
+
+        total = self._totals.get(user_id)
+        if total is None:
+            self._totals[user_id] = total = [0.0]
+        total[0] = self._scope(None).add(user_id, xp)
+
+    def add_batch(self, batch: dict, names: dict) -> int:
+        pairs = set()
+        with self._lock:
+            for (chat_id, user_id, day), (xp, ts) in batch.items():
+                self._apply(chat_id, user_id, xp, ts)
+                pairs.add((chat_id, user_id))
+            self._names.update(names)
+            for grain, bucket, scope, user_id, xp in rollup_rows(batch):
+                key = (grain, bucket, scope)
+                scores = self._rollup.get(key)
+                if scores is None:
+                    scores = self._rollup[key] = SortedScores()
+                scores.add(user_id, xp)
+            self._dirty = True
+        return len(pairs)
+
+    def top(self, chat_id, n: int) -> list:
+        with self._lock:
+            scores = self._scores.get(chat_id)
+            return scores.top(n) if scores else []
+
+    def user_xp(self, chat_id, user_id: int):
+        with self._lock:
+            row = self._totals.get(user_id) if chat_id is None else self._xp.get((chat_id, user_id))
+            return (row[0], *self._names.get(user_id, ("", ""))) if row else None
+
+    def iter_xp(self, chat_id=None, min_xp: float = 0):
+        with self._lock:
+            rows = [
+                (row_chat_id, user_id, *self._names.get(user_id, ("", "")), xp, ts)
+                for (row_chat_id, user_id), (xp, ts) in self._xp.items()
+                if xp >= min_xp and (chat_id is None or row_chat_id == chat_id)
+            ]
+        return iter(rows)
+
+    def iter_totals(self):
+        with self._lock:
+            return [
+                (user_id, total[0], *self._names.get(user_id, ("", "")))
+                for user_id, total in self._totals.items()
+            ]
+
+    def changed_since(self, since_ts: int) -> tuple:
+        with self._lock:
+            xp_rows = [
+                (chat_id, user_id, xp)
+                for (chat_id, user_id), (xp, ts) in self._xp.items() if ts >= since_ts
+            ]
+            totals = [
+                (user_id, self._totals[user_id][0], *self._names.get(user_id, ("", "")))
+                for user_id in {row[1] for row in xp_rows}
+            ]
+        return xp_rows, totals
+
+    def period_top(self, grain: str, bucket: int, scope: int, n: int) -> list:
+        with self._lock:
+            scores = self._rollup.get((grain, bucket, scope))
+            return scores.top(n) if scores else []
+
+    def period_cities(self, grain: str, bucket: int, user_ids: list) -> list:
+        rows = []
+        with self._lock:
+            for (row_grain, row_bucket, scope), scores in self._rollup.items():
+                if row_grain != grain or row_bucket != bucket or scope == 0:
+                    continue
+                for user_id in user_ids:
+                    xp = scores.get(user_id)
+                    if xp is not None:
+                        rows.append((scope, user_id, xp))
+        return rows
+
+    def period_user(self, grain: str, bucket: int, scope: int, user_id: int) -> tuple:
+        with self._lock:
+            scores = self._rollup.get((grain, bucket, scope))
+            if not scores:
+                return None, 0, 0
+            xp = scores.get(user_id)
+            if xp is None:
+                return None, 0, len(scores)
+            return xp, scores.count_at_least(floor(xp) + 1), len(scores)
+
+    def compact_rollups(self, day_bound: int, week_bound: int):
+        with self._lock:
+            for grain, bucket, scope in list(self._rollup):
+                if (grain == "d" and bucket < day_bound) or (grain == "w" and bucket < week_bound):
+                    del self._rollup[(grain, bucket, scope)]
+                    self._dirty = True
+
+    def archive_inactive(self, before_ts: int, max_xp: float, archived_ts: int) -> int:
+        with self._lock:
+            rows, active = {}, set()
+            for (chat_id, user_id), (xp, ts) in self._xp.items():
+                if ts >= before_ts:
+                    active.add(user_id)
+                rows.setdefault(user_id, []).append(chat_id)
+            user_ids = [
+                user_id for user_id, total in self._totals.items()
+                if total[0] < max_xp and user_id not in active
+            ]
+            for user_id in user_ids:
+                for chat_id in rows.get(user_id, ()):
+                    xp, ts = self._xp.pop((chat_id, user_id))
+                    entry = self._archive.get((chat_id, user_id))
+                    if entry:
+                        entry[:] = [entry[0] + xp, max(entry[1], ts), archived_ts]
+                    else:
+                        self._archive[(chat_id, user_id)] = [xp, ts, archived_ts]
+                    self._scope(chat_id).remove(user_id)
+                del self._totals[user_id]
+                self._scope(None).remove(user_id)
+            if user_ids:
+                self._dirty = True
+            return len(user_ids)
+
+    def _dump(self) -> bytes:
+        # Вызывается под self._lock
+        state = {
+            "xp": self._xp,
+            "totals": self._totals,
+            "names": self._names,
+            "archive": self._archive,
+            "rollup": {key: dict(scores.items()) for key, scores in self._rollup.items()},
+        }
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+
+    def snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = self._dump()
+            self._dirty = False
+        self._write(self.snapshot_path, data)
+
+    def snapshot_to(self, path: str):
+        # Копия текущего состояния в отдельный файл: резервные копии и /senddb
+        with self._lock:
+            data = self._dump()
+        self._write(path, data)
+
+    def _restore(self):
+        with open(self.snapshot_path, "rb") as src:
+            state = pickle.load(src)
+        self._xp = state["xp"]
+        # В старых снимках за суммой шли лучший город и его XP
+        self._totals = {user_id: total[:1] for user_id, total in state["totals"].items()}
+        self._names = state["names"]
+        self._archive = state.get("archive", {})
+        for (chat_id, user_id), entry in self._xp.items():
+            self._scope(chat_id).add(user_id, entry[0])
+        for user_id, total in self._totals.items():
+            self._scope(None).add(user_id, total[0])
+        for key, values in state["rollup"].items():
+            scores = self._rollup[key] = SortedScores()
+            for user_id, xp in values.items():
+                scores.add(user_id, xp)
+        logger.info(f"XP восстановлен из снимка {self.snapshot_path}: {len(self._xp)} записей")
+
+    def close(self):
+        self.snapshot()
+
+STORAGE_BACKENDS = {"sqlite": lambda: SqliteStorage(db), "memory": lambda: MemoryStorage(MEMORY_SNAPSHOT_PATH or None)}
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(f"Неизвестное хранилище XP: {STORAGE_BACKEND}")
+storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+snapshot_task = None
+if isinstance(storage, MemoryStorage) and storage.snapshot_path and MEMORY_SNAPSHOT_INTERVAL > 0:
+    snapshot_task = PeriodicTask("xp-snapshot", MEMORY_SNAPSHOT_INTERVAL, storage.snapshot)
+
+# ==============================================================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ XP (write-behind)
+# ==============================================================================
+
+class XpWriteBehind:
+    # Копит прирост XP по ключу (chat_id, user_id, сутки) и отдаёт его
+    # хранилищу одной пачкой — по размеру буфера или по таймеру, что наступит
+    # раньше. Сутки в ключе нужны, чтобы корзины периодов не смешались.
+
+    def __init__(self, store: XpStorage, flush_interval: float, batch_size: int):
+        self.storage = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="xp-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, chat_id: int, user_id: int, xp: float, ts: int):
+        key = (chat_id, user_id, period_start("d", ts))
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry:
+                entry[0] += xp
+                entry[1] = max(entry[1], ts)
+            else:
+                self._pending[key] = [xp, ts]
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def rename(self, user_id: int, first_name: str, last_name: str):
+        # Новое имя уходит в users вместе с ближайшей пачкой XP
+        with self._lock:
+            self._names[user_id] = (first_name, last_name)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def pending(self) -> list:
+        # Ещё не записанные дельты: [(chat_id, user_id, xp)]
+        with self._lock:
+            return [(chat_id, user_id, xp) for (chat_id, user_id, _), (xp, _) in self._pending.items()]
+
+    @contextmanager
+    def paused(self):
+        # Сброс в хранилище приостановлен: всё, чего там нет, остаётся в буфере
+        with self._flush_lock:
+            yield
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending and not self._names:
+                    return 0
+                batch, self._pending = self._pending, {}
+                names, self._names = self._names, {}
+
+            try:
+                return self.storage.add_batch(batch, names)
+            except Exception:
+                self._requeue(batch, names)
+                raise
+
+    def _requeue(self, batch: dict, names: dict):
+        # Не теряем дельты при ошибке записи: возвращаем их в буфер
+        with self._lock:
+            for key, (xp, ts) in batch.items():
+                entry = self._pending.get(key)
+                if entry:
+                    entry[0] += xp
+                    entry[1] = max(entry[1], ts)
+                else:
+                    self._pending[key] = [xp, ts]
+            for user_id, name in names.items():
+                # Более свежее имя, пришедшее за время записи, не затираем
+                self._names.setdefault(user_id, name)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось записать XP в базу: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+class NameCache:
+    # Последние записанные имена (LRU); changed() — True, только если имя
+    # новое или отличается, и тогда запоминает его
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def changed(self, user_id: int, first_name: str, last_name: str) -> bool:
+        name = (first_name, last_name)
+        with self._lock:
+            if self._names.get(user_id) == name:
+                self._names.move_to_end(user_id)
+                return False
+            self._names[user_id] = name
+            self._names.move_to_end(user_id)
+            if len(self._names) > self.max_entries:
+                self._names.popitem(last=False)
+            return True
+
+    def load(self, rows):
+        # rows: (user_id, _, first_name, last_name), как у XpStorage.iter_totals()
+        with self._lock:
+            for user_id, _, first_name, last_name in islice(rows, self.max_entries):
+                self._names[user_id] = (first_name, last_name)
+
+xp_writer = XpWriteBehind(storage, XP_FLUSH_INTERVAL, XP_FLUSH_BATCH)
+user_names = NameCache(USER_NAME_CACHE_SIZE)
+user_names.load(iter(storage.iter_totals()))
+rollup_compactor = PeriodicTask(
+    "rollup-compactor", ROLLUP_COMPACT_INTERVAL, lambda: compact_rollups(storage, time.time())
+)
+
+# ==============================================================================
+# ИНДЕКС МЕСТ В РЕЙТИНГЕ (в памяти)
+# ==============================================================================
+
+class FenwickTree:
+    def __init__(self, size: int):
+        self.size = size
+        self._tree = [0] * (size + 1)
+
+    def add(self, index: int, delta: int):
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index: int) -> int:
+        # Сумма по позициям 0..index включительно
+        i = min(index + 1, self.size)
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+class XpRankIndex:
+    # Дерево Фенвика по целым значениям XP: место пользователя — это
+    # 1 + число пользователей с бо́льшим целым XP, считается за O(log max_xp).
+    # Целая часть совпадает с тем, что бот показывает в ответах.
+
+    def __init__(self, size: int = 1024):
+        self._scores = {}
+        self._tree = FenwickTree(size)
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def get(self, user_id: int) -> float:
+        return self._scores.get(user_id, 0.0)
+
+    def set(self, user_id: int, xp: float):
+        old = self._scores.get(user_id)
+        if old is not None:
+            self._tree.add(int(old), -1)
+        self._scores[user_id] = xp
+        bucket = int(xp)
+        if bucket >= self._tree.size:
+            self._grow(bucket)
+        else:
+            self._tree.add(bucket, 1)
+
+    def add(self, user_id: int, delta: float) -> float:
+        xp = self.get(user_id) + delta
+        self.set(user_id, xp)
+        return xp
+
+    def _grow(self, bucket: int):
+        size = self._tree.size
+        while size <= bucket:
+            size *= 2
+        self._tree = FenwickTree(size)
+        for xp in self._scores.values():
+            self._tree.add(int(xp), 1)
+
+    def position(self, user_id: int):
+        xp = self._scores.get(user_id)
+        if xp is None:
+            return None
+        return len(self._scores) - self._tree.prefix_sum(int(xp)) + 1
+
+class TopK:
+    # Лучшие k пользователей по XP. XP только растёт, поэтому чужак попадает
+    # в топ, лишь обогнав текущий минимум — его и вытесняем. Куча ленивая:
+    # устаревшие записи отбрасываются при взгляде на вершину.
+
+    def __init__(self, k: int):
+        self.k = k
+        self._members = {}
+        self._heap = []
+
+    def update(self, user_id: int, xp: float):
+        if user_id not in self._members and len(self._members) >= self.k:
+            min_xp, min_user = self._peek_min()
+            if xp <= min_xp:
+                return
+            del self._members[min_user]
+            heapq.heappop(self._heap)
+        self._members[user_id] = xp
+        heapq.heappush(self._heap, (xp, user_id))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(v, u) for u, v in self._members.items()]
+            heapq.heapify(self._heap)
+
+    def _peek_min(self) -> tuple:
+        while self._members.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def top(self, n: int) -> list:
+        return sorted(self._members.items(), key=lambda item: item[1], reverse=True)[:n]
+
+class Leaderboard:
+    # Рейтинги целиком в памяти: индекс мест и топ-K на каждый город и на
+    # глобальную сумму, плюс последние известные имена пользователей.
+
+    def __init__(self, k: int):
+        self.k = k
+        self._lock = threading.Lock()
+        self._cities = {}
+        self._city_tops = {}
+        self._global = XpRankIndex()
+        self._global_top = TopK(k)
+        self._names = {}
+        # record_xp кладёт дельту в буфер записи и в рейтинг под этой
+        # блокировкой, чтобы load() доиграл буфер ровно один раз
+        self.record_lock = threading.Lock()
+
+    def _city(self, chat_id: int) -> XpRankIndex:
+        index = self._cities.get(chat_id)
+        if index is None:
+            index = self._cities[chat_id] = XpRankIndex()
+        return index
+
+    def _city_top(self, chat_id: int) -> TopK:
+        top = self._city_tops.get(chat_id)
+        if top is None:
+            top = self._city_tops[chat_id] = TopK(self.k)
+        return top
+
+    def add(self, chat_id: int, user_id: int, delta: float, first_name: str, last_name: str):
+        with self._lock:
+            self._city_top(chat_id).update(user_id, self._city(chat_id).add(user_id, delta))
+            self._global_top.update(user_id, self._global.add(user_id, delta))
+            self._names[user_id] = (first_name, last_name)
+
+    def position(self, chat_id, user_id: int) -> tuple:
+        # chat_id=None — глобальный рейтинг; возвращает (место или None, всего)
+        with self._lock:
+            index = self._global if chat_id is None else self._city(chat_id)
+            return index.position(user_id), len(index)
+
+    def user_xp(self, chat_id, user_id: int) -> float:
+        # Вместе с ещё не записанным в базу — рейтинг обновляется в record_xp
+        with self._lock:
+            index = self._global if chat_id is None else self._city(chat_id)
+            return index.get(user_id)
+
+    def name(self, user_id: int) -> tuple:
+        with self._lock:
+            return self._names.get(user_id, ("", ""))
+
+    def _best_chat(self, user_id: int) -> int:
+        best_chat_id, best_xp = 0, 0.0
+        for chat_id, index in self._cities.items():
+            xp = index.get(user_id)
+            if xp > best_xp:
+                best_chat_id, best_xp = chat_id, xp
+        return best_chat_id
+
+    def top(self, chat_id, n: int) -> list:
+        # Строки (user_id, xp, first_name, last_name, chat_id); для глобального
+        # топа chat_id — город, где у пользователя больше всего XP
+        with self._lock:
+            if chat_id is None:
+                return [
+                    (user_id, xp, *self._names.get(user_id, ("", "")), self._best_chat(user_id))
+                    for user_id, xp in self._global_top.top(n)
+                ]
+            return [
+                (user_id, xp, *self._names.get(user_id, ("", "")), chat_id)
+                for user_id, xp in self._city_top(chat_id).top(n)
+            ]
+
+    def load(self, store: XpStorage, pending=None):
+        # pending() — дельты, которых ещё нет в store (XpWriteBehind.pending)
+        cities = {}
+        city_tops = {}
+        for chat_id, user_id, _, _, total_xp, _ in store.iter_xp():
+            cities.setdefault(chat_id, XpRankIndex()).set(user_id, total_xp)
+            city_tops.setdefault(chat_id, TopK(self.k)).update(user_id, total_xp)
+        global_index = XpRankIndex()
+        global_top = TopK(self.k)
+        names = {}
+        for user_id, total_xp, first_name, last_name in store.iter_totals():
+            global_index.set(user_id, total_xp)
+            global_top.update(user_id, total_xp)
+            names[user_id] = (first_name, last_name)
+        with self.record_lock, self._lock:
+            for chat_id, user_id, xp in (pending() if pending else ()):
+                city_xp = cities.setdefault(chat_id, XpRankIndex()).add(user_id, xp)
+                city_tops.setdefault(chat_id, TopK(self.k)).update(user_id, city_xp)
+                global_top.update(user_id, global_index.add(user_id, xp))
+                # Имя из свежего апдейта, даже если в users оно ещё не записано
+                if user_id in self._names:
+                    names[user_id] = self._names[user_id]
+            self._cities = cities
+            self._city_tops = city_tops
+            self._global = global_index
+            self._global_top = global_top
+            self._names = names
+
+    def merge(self, xp_rows: list, totals: list, pending=None):
+        # Догрузка изменённых строк (XpStorage.changed_since) поверх текущего
+        # рейтинга: значение из хранилища плюс ещё не записанные дельты
+        with self.record_lock, self._lock:
+            unsaved = {}
+            for chat_id, user_id, xp in (pending() if pending else ()):
+                unsaved[(chat_id, user_id)] = unsaved.get((chat_id, user_id), 0.0) + xp
+                unsaved[(None, user_id)] = unsaved.get((None, user_id), 0.0) + xp
+            for chat_id, user_id, total_xp in xp_rows:
+                xp = total_xp + unsaved.get((chat_id, user_id), 0.0)
+                self._city(chat_id).set(user_id, xp)
+                self._city_top(chat_id).update(user_id, xp)
+            for user_id, total_xp, first_name, last_name in totals:
+                xp = total_xp + unsaved.get((None, user_id), 0.0)
+                self._global.set(user_id, xp)
+                self._global_top.update(user_id, xp)
+                # У пользователей с дельтой в буфере имя свежее, чем в базе
+                if (None, user_id) not in unsaved:
+                    self._names[user_id] = (first_name, last_name)
+
+leaderboard = Leaderboard(LEADERBOARD_TOP_K)
+leaderboard.load(storage)
+
+def format_position(position, count: int) -> str:
+    if position is None:
+        return f"📊 Место: — (в рейтинге {count} участников)"
+    return f"📊 Место: #{position} из {count}"
+
+# ==============================================================================
+# КЭШ ГОТОВЫХ ОТВЕТОВ
+# ==============================================================================
+
+class DataVersions:
+    # Версия данных каждого города и общая. Новое значение берётся из общего
+    # счётчика, а не +1: две одновременные записи не получат одну версию,
+    # и текст, собранный между ними, не будет выдан за актуальный.
+    def __init__(self):
+        self._seq = count(1)
+        self._cities = {}
+        self.base = 0   # версия последней полной перезагрузки рейтинга
+        self.total = 0
+
+    def bump(self, chat_id: int):
+        version = next(self._seq)
+        self._cities[chat_id] = version
+        self.total = version
+
+    def bump_all(self):
+        # Рейтинг перечитан из базы целиком — старые тексты не годятся
+        self._cities.clear()
+        self.base = self.total = next(self._seq)
+
+    def get(self, chat_id) -> int:
+        # chat_id=None — глобальный рейтинг, он меняется от любого города
+        if chat_id is None:
+            return self.total
+        return self._cities.get(chat_id, self.base)
+
+class ResponseCache:
+    # LRU готовых текстов; версия данных входит в ключ, поэтому устаревшие
+    # записи не удаляются явно, а просто вытесняются
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            text = self._items.get(key)
+            if text is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return text
+            self.misses += 1
+        text = render()
+        with self._lock:
+            self._items[key] = text
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return text
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+data_versions = DataVersions()
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def reload_leaderboard(store: XpStorage = storage):
+    # Рейтинг заново из хранилища. Пока он читается, буфер записи не
+    # сбрасывается: всё, чего в хранилище нет, лежит в буфере и доигрывается
+    # в новый индекс при подмене, так что XP, пришедший во время чтения, не теряется
+    xp_writer.flush()
+    with xp_writer.paused():
+        leaderboard.load(store, xp_writer.pending)
+    data_versions.bump_all()
+
+metrics.gauge("faba_response_cache_requests_total", "Запросы к кэшу готовых ответов", lambda: {
+    (("result", "hit"),): response_cache.hits,
+    (("result", "miss"),): response_cache.misses,
+}, kind="counter")
+metrics.gauge("faba_response_cache_hit_ratio", "Доля ответов из кэша",
+              lambda: response_cache.stats()["hit_ratio"])
 
 # ==============================================================================
 # ХЭНДЛЕР ЗАПИСИ XP В БАЗУ
 # ==============================================================================
 
+class XpRateLimiter:
+    # Скользящее окно по каждой паре (chat_id, user_id): за последние
+    # window секунд начисляется не больше cap XP, остаток отрезается.
+    # OrderedDict упорядочен по последней активности, поэтому простаивающие
+    # записи лежат в начале и вычищаются за O(1) на сообщение.
+
+    def __init__(self, window: float, cap: float, max_entries: int):
+        self.window = window
+        self.cap = cap
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def grant(self, key: tuple, xp: float, now: float) -> float:
+        bound = now - self.window
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [deque(), 0.0]
+            else:
+                self._entries.move_to_end(key)
+
+            events = entry[0]
+            while events and events[0][0] <= bound:
+                entry[1] -= events.popleft()[1]
+
+            granted = min(xp, self.cap - entry[1])
+            if granted > 0:
+                events.append((now, granted))
+                entry[1] += granted
+            self._expire(bound)
+        return max(granted, 0.0)
+
+    def _expire(self, bound: float):
+        while self._entries:
+            key, (events, _) = next(iter(self._entries.items()))
+            idle = not events or events[-1][0] <= bound
+            if not idle and len(self._entries) <= self.max_entries:
+                return
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+xp_limiter = XpRateLimiter(XP_WINDOW_SECONDS, XP_CAP_PER_MINUTE, XP_LIMITER_MAX_USERS)
+
 def record_xp(update: Update, context: CallbackContext):
     message = update.effective_message
     chat    = update.effective_chat
     user    = update.effective_user
 
-    valid_chat_ids = {city["chat_id"] for city in ALL_CITIES}
-    if chat.type not in ("group", "supergroup") or chat.id not in valid_chat_ids:
+    if chat.type not in ("group", "supergroup") or chat.id not in cities.chat_ids:
         return
     if not user or user.is_bot:
         return
 
     text = message.text or message.caption or ""
-    xp_gain = calc_message_xp(text)
+    xp_gain = xp_limiter.grant((chat.id, user.id), calc_message_xp(text), time.monotonic())
+    if xp_gain <= 0:
+        return
     now_ts = int(time.time())
-    minute_bound = now_ts - 60
 
-    first_name = user.first_name or ""
-    last_name  = user.last_name  or ""
+    first_name, last_name = user.first_name or "", user.last_name or ""
+    if user_names.changed(user.id, first_name, last_name):
+        xp_writer.rename(user.id, first_name, last_name)
+    with leaderboard.record_lock:
+        xp_writer.add(chat.id, user.id, xp_gain, now_ts)
+        leaderboard.add(chat.id, user.id, xp_gain, first_name, last_name)
+    data_versions.bump(chat.id)
 
-    conn = sqlite3.connect(DB_PATH)
-    cur  = conn.cursor()
+# ==============================================================================
+# РЕЙТИНГ ЗА ПЕРИОД (из корзин xp_rollup)
+# ==============================================================================
 
-    cur.execute(
-        "SELECT total_xp, last_msg_ts FROM xp WHERE chat_id = ? AND user_id = ?",
-        (chat.id, user.id)
-    )
-    row = cur.fetchone()
-    if row:
-        total_xp, last_msg_ts = row
+def period_top(grain: str, chat_id, n: int) -> list:
+    # Строки в том же виде, что и Leaderboard.top()
+    bucket = period_start(grain, time.time())
+    rows = storage.period_top(grain, bucket, chat_id or 0, n)
+    if chat_id:
+        best = {user_id: chat_id for user_id, _ in rows}
     else:
-        total_xp, last_msg_ts = 0.0, 0
+        # Лучший город за период для всех строк топа — одним запросом
+        user_ids = [user_id for user_id, _ in rows]
+        best, best_xp = {}, {}
+        for city_id, user_id, xp in storage.period_cities(grain, bucket, user_ids):
+            if xp > best_xp.get(user_id, 0.0):
+                best[user_id], best_xp[user_id] = city_id, xp
+    return [
+        (user_id, xp, *leaderboard.name(user_id), best.get(user_id, 0))
+        for user_id, xp in rows
+    ]
+
+def period_user_stats(grain: str, chat_id, user_id: int) -> tuple:
+    # (XP за период, место или None, всего участников)
+    bucket = period_start(grain, time.time())
+    xp, above, count = storage.period_user(grain, bucket, chat_id or 0, user_id)
+    if xp is None:
+        return 0.0, None, count
+    return xp, above + 1, count
 
-    if last_msg_ts >= minute_bound and xp_gain > XP_CAP_PER_MINUTE:
-        conn.close()
+# ==============================================================================
+# СНИМКИ БАЗЫ, ВЫГРУЗКА xp И РЕЗЕРВНЫЕ КОПИИ
+# ==============================================================================
+
+def snapshot_db(database: Database, target_path: str):
+    # Согласованная копия через online backup API. Копируем по BACKUP_PAGES
+    # страниц с паузой, так что запись XP между шагами не ждёт конца копии
+    target = sqlite3.connect(target_path)
+    try:
+        database.connection().backup(target, pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP)
+    finally:
+        target.close()
+
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ("chat_id", "city", "user_id", "first_name", "last_name", "total_xp", "last_msg_ts")
+
+def iter_xp_rows(store: XpStorage, chat_id=None, min_xp: float = 0):
+    for row_chat_id, user_id, first_name, last_name, total_xp, last_msg_ts in store.iter_xp(chat_id, min_xp):
+        yield (row_chat_id, get_city_name(row_chat_id), user_id,
+               first_name, last_name, int(total_xp), last_msg_ts)
+
+def export_lines(rows, fmt: str):
+    if fmt == "jsonl":
+        for row in rows:
+            yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
         return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def write_export(path: str, store: XpStorage, fmt: str, chat_id=None, min_xp: float = 0) -> int:
+    # Строки сразу уходят в gzip на диск; возвращает число выгруженных строк
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as out:
+        for line in export_lines(counted(iter_xp_rows(store, chat_id, min_xp)), fmt):
+            out.write(line)
+    return count
+
+def backup_now(database: Database, store: XpStorage = storage, directory: str = BACKUP_DIR,
+               keep: int = BACKUP_KEEP) -> list:
+    # Возвращает пути копий: база SQLite и, при STORAGE_BACKEND=memory, снимок
+    # XP из памяти — в самой базе тогда только служебные таблицы
+    os.makedirs(directory, exist_ok=True)
+    xp_writer.flush()
+    stamp = datetime.now(BUCKET_TZ).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"activity-{stamp}.db")
+    # Пишем во временный файл, чтобы в ротацию не попала недописанная копия
+    snapshot_db(database, path + ".part")
+    os.replace(path + ".part", path)
+    paths = [path]
+    if isinstance(store, MemoryStorage):
+        paths.append(os.path.join(directory, f"activity-{stamp}.snapshot"))
+        store.snapshot_to(paths[-1])
+    for suffix in (".db", ".snapshot"):
+        copies = sorted(name for name in os.listdir(directory)
+                        if name.startswith("activity-") and name.endswith(suffix))
+        if keep > 0:
+            for name in copies[:-keep]:
+                os.remove(os.path.join(directory, name))
+    logger.info(f"Резервная копия базы: {', '.join(paths)}")
+    return paths
+
+backup_task = None
+if BACKUP_INTERVAL > 0:
+    backup_task = PeriodicTask("db-backup", BACKUP_INTERVAL, lambda: backup_now(db))
 
-    total_xp += xp_gain
+# ==============================================================================
+# ОБСЛУЖИВАНИЕ БАЗЫ (архив, incremental_vacuum, ANALYZE, checkpoint)
+# ==============================================================================
 
-    cur.execute(
-        """
-        INSERT INTO xp (chat_id, user_id, total_xp, last_msg_ts, first_name, last_name)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(chat_id, user_id) DO UPDATE SET
-            total_xp    = excluded.total_xp,
-            last_msg_ts = excluded.last_msg_ts,
-            first_name  = excluded.first_name,
-            last_name   = excluded.last_name
-        """,
-        (chat.id, user.id, total_xp, now_ts, first_name, last_name)
+def db_size(database: Database) -> int:
+    # Файл базы вместе с WAL
+    size = 0
+    for suffix in ("", "-wal"):
+        try:
+            size += os.path.getsize(database.path + suffix)
+        except OSError:
+            pass
+    return size
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def incremental_vacuum(database: Database, pages: int = VACUUM_STEP_PAGES, pause: float = VACUUM_STEP_SLEEP) -> int:
+    # Свободные страницы отдаются файлу по pages за транзакцию с паузой между
+    # шагами, чтобы запись XP не ждала весь проход. Возвращает число страниц.
+    freed = 0
+    free = database.query_one("PRAGMA freelist_count")[0]
+    while free:
+        with database.transaction() as conn:
+            # Прагма отдаёт по странице на шаг, а sqlite3 делает у запроса без
+            # столбцов ровно один шаг — поэтому шагаем сами
+            for _ in range(min(pages, free)):
+                conn.execute("PRAGMA incremental_vacuum(1)")
+        left = database.query_one("PRAGMA freelist_count")[0]
+        if left >= free:
+            break
+        freed += free - left
+        free = left
+        time.sleep(pause)
+    return freed
+
+def run_maintenance(database: Database, store: XpStorage, now: float) -> str:
+    started = time.monotonic()
+    size_before = db_size(database)
+    lines = []
+
+    if ARCHIVE_INACTIVE_DAYS > 0:
+        xp_writer.flush()
+        archived = store.archive_inactive(int(now) - ARCHIVE_INACTIVE_DAYS * 86400, ARCHIVE_MAX_XP, int(now))
+        if archived:
+            # Места и «всего участников» в памяти — уже без архивных; новая
+            # эпоха заставит соседние воркеры тоже перечитать рейтинг целиком
+            reload_leaderboard(store)
+            with database.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('leaderboard_epoch', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(int(now)),)
+                )
+        lines.append(f"• в архив: {archived} польз. (нет сообщений {ARCHIVE_INACTIVE_DAYS} дн., "
+                     f"меньше {ARCHIVE_MAX_XP:g} XP)")
+
+    conn = database.connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Существующую базу в INCREMENTAL переводит только полный VACUUM — один раз
+        with SQLITE_SECONDS.time(op="vacuum"):
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        lines.append("• auto_vacuum переведён в INCREMENTAL (полный VACUUM)")
+    with SQLITE_SECONDS.time(op="vacuum"):
+        freed = incremental_vacuum(database)
+    lines.append(f"• освобождено страниц: {freed}")
+
+    with SQLITE_SECONDS.time(op="analyze"):
+        # analysis_limit — ANALYZE по выборке строк, а не по всей таблице
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("ANALYZE")
+    busy, wal_pages, moved = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if busy:
+        lines.append(f"• checkpoint WAL: занят читателями, перенесено {moved} из {wal_pages} страниц")
+    else:
+        lines.append("• ANALYZE и checkpoint WAL выполнены")
+
+    lines.insert(0, f"Обслуживание базы за {time.monotonic() - started:.1f} с: "
+                    f"{format_size(size_before)} → {format_size(db_size(database))}")
+    return "\n".join(lines)
+
+maintenance_lock = threading.Lock()
+
+def maintain(admin_chat_id: int = YOUR_ID) -> bool:
+    # False — обслуживание уже идёт в этом процессе
+    if not maintenance_lock.acquire(blocking=False):
+        return False
+    try:
+        report = run_maintenance(db, storage, time.time())
+        logger.info(report)
+    except Exception as e:
+        report = f"Обслуживание базы прервано: {e}"
+        logger.error(report)
+    finally:
+        maintenance_lock.release()
+    try:
+        bot.send_message(chat_id=admin_chat_id, text=report)
+    except TelegramError as e:
+        logger.error(f"Не удалось отправить отчёт об обслуживании: {e}")
+    return True
+
+def maintenance_due(now: float) -> bool:
+    # Раз в сутки в MAINTENANCE_HOUR; из нескольких воркеров запускает первый
+    local = datetime.fromtimestamp(now, timezone(timedelta(hours=BUCKET_TZ_OFFSET)))
+    return local.hour == MAINTENANCE_HOUR and claim_once("maintenance", local.strftime("%Y-%m-%d"))
+
+maintenance_task = None
+if MAINTENANCE_HOUR >= 0:
+    maintenance_task = PeriodicTask(
+        "db-maintenance", MAINTENANCE_CHECK_INTERVAL, lambda: maintenance_due(time.time()) and maintain()
     )
-    conn.commit()
-    conn.close()
 
 # ==============================================================================
 # КОМАНДА /top
 # ==============================================================================
 
 def cmd_top(update: Update, context: CallbackContext):
-    user = update.effective_user
-    chat = update.effective_chat
+    args = list(context.args or [])
+    grain = None
+    if args and args[0].lower() in PERIOD_GRAINS:
+        grain = PERIOD_GRAINS[args.pop(0).lower()]
 
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
-    args = context.args
-    city_map = {city["name"].lower(): city["chat_id"] for city in ALL_CITIES}
     target_chat_id = None
     n = 10
 
     if args:
         if args[-1].isdigit():
-            n = max(1, min(int(args[-1]), 50))
+            n = max(1, min(int(args[-1]), LEADERBOARD_TOP_K))
             city_part = " ".join(args[:-1]).strip().lower()
         else:
             city_part = " ".join(args).strip().lower()
 
         if city_part:
-            if city_part not in city_map:
+            target_chat_id = cities.find(city_part)
+            if target_chat_id is None:
                 update.message.reply_text(
-                    f"Город «{city_part}» не найден. Доступные: {', '.join(city_map.keys())}.",
+                    f"Город «{city_part}» не найден. Доступные: {cities.names()}.",
                     quote=True
                 )
                 return
-            target_chat_id = city_map[city_part]
 
-    conn = sqlite3.connect(DB_PATH)
-    cur  = conn.cursor()
-    lines = []
+    # Повторный одинаковый запрос без новых сообщений — один поиск в словаре
+    bucket = period_start(grain, time.time()) if grain else None
+    key = ("top", grain, bucket, target_chat_id, n, data_versions.get(target_chat_id), cities.version)
+    text = response_cache.get_or_render(key, lambda: render_top(grain, target_chat_id, n))
+    if text:
+        update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    else:
+        update.message.reply_text("Пока нет данных.", quote=True)
+
+def render_top(grain, target_chat_id, n: int) -> str:
+    # Пустая строка — данных нет
+    if grain:
+        xp_writer.flush()
+        rows = period_top(grain, target_chat_id, n)
+    else:
+        rows = leaderboard.top(target_chat_id, n)
+    if not rows:
+        return ""
 
+    period = f" {PERIOD_TITLES[grain]}" if grain else ""
     if target_chat_id:
-        cur.execute(
-            "SELECT user_id, total_xp, first_name, last_name "
-            "FROM xp WHERE chat_id = ? ORDER BY total_xp DESC LIMIT ?",
-            (target_chat_id, n)
-        )
-        rows = cur.fetchall()
-        city_name_display = get_city_name(target_chat_id)
-        title = f"Топ-{n} в «{city_name_display}»"
-        if not rows:
-            update.message.reply_text("Пока нет данных.", quote=True)
-            conn.close()
-            return
+        lines = [f"🏆 Топ-{n}{period} в «{get_city_name(target_chat_id)}»:"]
+    else:
+        lines = [f"🏆 Глобальный топ-{n}{period}:"]
 
-        lines.append(f"🏆 {title}:")
-        rank = 1
-        for user_id, xp, first_name, last_name in rows:
-            display_name = f"{first_name} {last_name}".strip() or f"ID:{user_id}"
-            html_name = f'<a href="tg://user?id={user_id}">{display_name}</a>'
-            lines.append(f"{rank}. {html_name} ({city_name_display}) — {int(xp)} XP")
-            rank += 1
+    rank = 1
+    for user_id, xp, first_name, last_name, chat_id in rows:
+        display_name = f"{first_name} {last_name}".strip() or f"ID:{user_id}"
+        html_name = f'<a href="tg://user?id={user_id}">{display_name}</a>'
+        lines.append(f"{rank}. {html_name} ({get_city_name(chat_id)}) — {int(xp)} XP")
+        rank += 1
+    return "\n".join(lines)
+
+# ==============================================================================
+# КОМАНДА /topcheck (сверка рейтинга в памяти с базой)
+# ==============================================================================
 
+def cmd_topcheck(update: Update, context: CallbackContext):
+    xp_writer.flush()
+    scopes = [(None, "Глобальный")] + [(city["chat_id"], city["name"]) for city in cities.all()]
+
+    mismatches = []
+    for chat_id, name in scopes:
+        expected = [round(xp, 6) for _, xp in storage.top(chat_id, LEADERBOARD_TOP_K)]
+        actual = [round(row[1], 6) for row in leaderboard.top(chat_id, LEADERBOARD_TOP_K)]
+        if expected != actual:
+            mismatches.append(f"• {name}: в памяти {len(actual)}, в базе {len(expected)}")
+
+    if not mismatches:
+        update.message.reply_text("✅ Рейтинг в памяти совпадает с базой.", quote=True)
+        return
+
+    text = "⚠️ Расхождения рейтинга с базой:\n" + "\n".join(mismatches)
+    if context.args and context.args[0].lower() == "fix":
+        reload_leaderboard()
+        text += "\nРейтинг в памяти перестроен из базы."
     else:
-        cur.execute(
-            """
-            SELECT user_id, SUM(total_xp) AS sum_xp
-              FROM xp
-             GROUP BY user_id
-             ORDER BY sum_xp DESC
-             LIMIT ?
-            """,
-            (n,)
-        )
-        top_users = cur.fetchall()
-        if not top_users:
-            update.message.reply_text("Пока нет данных.", quote=True)
-            conn.close()
-            return
+        text += "\nПерестроить: /topcheck fix"
+    update.message.reply_text(text, quote=True)
 
-        lines.append(f"🏆 Глобальный топ-{n}:")
-        rank = 1
-        for user_id, sum_xp in top_users:
-            cur.execute(
-                "SELECT chat_id FROM xp WHERE user_id = ? ORDER BY total_xp DESC LIMIT 1",
-                (user_id,)
-            )
-            top_chat_row = cur.fetchone()
-            chat_name = get_city_name(top_chat_row[0]) if top_chat_row else "Неизвестно"
+# ==============================================================================
+# КОМАНДА /explain (планы горячих запросов)
+# ==============================================================================
 
-            cur.execute(
-                "SELECT first_name, last_name FROM xp WHERE user_id = ? LIMIT 1",
-                (user_id,)
-            )
-            name_row = cur.fetchone()
-            first_name, last_name = name_row if name_row else ("", "")
-            display_name = f"{first_name} {last_name}".strip() or f"ID:{user_id}"
-            html_name = f'<a href="tg://user?id={user_id}">{display_name}</a>'
+# Горячие запросы с примерными параметрами; для каждого проверяем, что SQLite
+# не скатывается к полному сканированию таблицы
+HOT_QUERIES = {
+    "xp upsert": (XP_UPSERT_SQL, (0, 0, 0.0, 0)),
+    "user_totals upsert": (USER_TOTALS_UPSERT_SQL, (0, 0.0)),
+    "users upsert": (USERS_UPSERT_SQL, (0, "", "")),
+    "топ города": ("SELECT user_id, total_xp FROM xp WHERE chat_id = ? ORDER BY total_xp DESC LIMIT ?", (0, 50)),
+    "глобальный топ": ("SELECT user_id, total_xp FROM user_totals ORDER BY total_xp DESC LIMIT ?", (50,)),
+    "/rank по городу": (USER_CITY_XP_SQL, (0, 0)),
+    "/rank глобально": (USER_TOTAL_SQL, (0,)),
+    "города пользователя": ("SELECT chat_id, total_xp FROM xp WHERE user_id = ?", (0,)),
+    "корзина upsert": (ROLLUP_UPSERT_SQL, ("d", 0, 0, 0, 0.0)),
+    "топ за период": (
+        "SELECT user_id, xp FROM xp_rollup "
+        "WHERE grain = ? AND bucket = ? AND chat_id = ? ORDER BY xp DESC LIMIT ?",
+        ("w", 0, 0, 50)
+    ),
+    "место за период": (
+        "SELECT COUNT(*) FROM xp_rollup WHERE grain = ? AND bucket = ? AND chat_id = ? AND xp >= ?",
+        ("w", 0, 0, 1.0)
+    ),
+}
 
-            lines.append(f"{rank}. {html_name} ({chat_name}) — {int(sum_xp)} XP")
-            rank += 1
+def is_table_scan(detail: str) -> bool:
+    # «SCAN xp» — полный проход по таблице; «SCAN ... USING INDEX» — обход индекса
+    return detail.startswith("SCAN") and "USING" not in detail
+
+def explain_hot_queries(database: Database) -> list:
+    report = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in database.query(f"EXPLAIN QUERY PLAN {sql}", params)]
+        warnings = [d for d in plan if is_table_scan(d) or "TEMP B-TREE" in d]
+        report.append((name, plan, warnings))
+    return report
+
+def cmd_explain(update: Update, context: CallbackContext):
+    lines = [f"<b>Планы запросов (схема v{schema_version(db)}):</b>"]
+    for name, plan, warnings in explain_hot_queries(db):
+        mark = "⚠️" if warnings else "✅"
+        lines.append(f"{mark} <b>{name}</b>")
+        for detail in plan:
+            lines.append(f"    <code>{detail}</code>")
 
-    conn.close()
     update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 # ==============================================================================
@@ -290,110 +2298,83 @@ def cmd_top(update: Update, context: CallbackContext):
 
 def cmd_rank(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
-    args = context.args
-    city_map = {city["name"].lower(): city["chat_id"] for city in ALL_CITIES}
 
-    conn = sqlite3.connect(DB_PATH)
-    cur  = conn.cursor()
+    args = list(context.args or [])
+    grain = None
+    if args and args[0].lower() in PERIOD_GRAINS:
+        grain = PERIOD_GRAINS[args.pop(0).lower()]
 
     if args:
-        city_name = " ".join(args).lower()
-        if city_name not in city_map:
+        target_chat_id = cities.find(" ".join(args))
+        if target_chat_id is None:
             update.message.reply_text(
-                f"Город «{' '.join(args)}» не найден. Доступные: {', '.join(city_map.keys())}.",
+                f"Город «{' '.join(args)}» не найден. Доступные: {cities.names()}.",
                 quote=True
             )
-            conn.close()
             return
-        target_chat_id = city_map[city_name]
-
-        cur.execute(
-            "SELECT total_xp, first_name, last_name FROM xp WHERE chat_id = ? AND user_id = ?",
-            (target_chat_id, user.id)
-        )
-        row = cur.fetchone()
-        conn.close()
-
-        if row:
-            total, first_name, last_name = row
-        else:
-            total, first_name, last_name = 0.0, "", ""
-
-        level = floor(sqrt(total))
-        to_next = (level + 1) ** 2 - total
-        display_name = f"{first_name} {last_name}".strip() or f"ID:{user.id}"
-        city_display = city_name.title()
-
+        scope_display = f"в «{get_city_name(target_chat_id)}»"
+    else:
+        target_chat_id = None
+        scope_display = "по всем городам"
+
+    # Без периода всё берётся из рейтинга в памяти — без записи в базу и без
+    # запроса; корзины периодов есть только в базе, для них сбрасываем буфер
+    first_name, last_name = leaderboard.name(user.id)
+    if not (first_name or last_name):
+        first_name, last_name = user.first_name or "", user.last_name or ""
+    display_name = f"{first_name} {last_name}".strip() or f"ID:{user.id}"
+
+    if grain:
+        xp_writer.flush()
+        period_xp, position, count = period_user_stats(grain, target_chat_id, user.id)
         text = (
-            f"👤 {display_name}, ваши очки в «{city_display}»: {int(total)}\n"
-            f"🎓 Уровень: {level} (до следующего уровня осталось {int(to_next)} XP)"
+            f"👤 {display_name}, ваши очки {PERIOD_TITLES[grain]} {scope_display}: {int(period_xp)}\n"
+            f"{format_position(position, count)}"
         )
         update.message.reply_text(text, quote=True)
+        return
 
-    else:
-        cur.execute(
-            "SELECT SUM(total_xp) FROM xp WHERE user_id = ?",
-            (user.id,)
-        )
-        row = cur.fetchone()
-        total = row[0] if row and row[0] is not None else 0.0
-
-        level = floor(sqrt(total))
-        to_next = (level + 1) ** 2 - total
-
-        cur.execute(
-            "SELECT first_name, last_name FROM xp WHERE user_id = ? LIMIT 1",
-            (user.id,)
-        )
-        name_row = cur.fetchone()
-        conn.close()
+    total = leaderboard.user_xp(target_chat_id, user.id)
+    level = floor(sqrt(total))
+    to_next = (level + 1) ** 2 - total
+    position, count = leaderboard.position(target_chat_id, user.id)
 
-        if name_row:
-            first_name, last_name = name_row
-        else:
-            first_name, last_name = "", ""
-        display_name = f"{first_name} {last_name}".strip() or f"ID:{user.id}"
+    if target_chat_id:
+        headline = f"👤 {display_name}, ваши очки {scope_display}: {int(total)}"
+    else:
+        headline = f"👤 {display_name}, ваши суммарные очки {scope_display}: {int(total)}"
 
-        text = (
-            f"👤 {display_name}, ваши суммарные очки по всем городам: {int(total)}\n"
-            f"🎓 Уровень: {level} (до следующего уровня осталось {int(to_next)} XP)"
-        )
-        update.message.reply_text(text, quote=True)
+    text = (
+        f"{headline}\n"
+        f"🎓 Уровень: {level} (до следующего уровня осталось {int(to_next)} XP)\n"
+        f"{format_position(position, count)}"
+    )
+    update.message.reply_text(text, quote=True)
 
 # ==============================================================================
 # КОМАНДА /dbdump
 # ==============================================================================
 
 def cmd_dbdump(update: Update, context: CallbackContext):
-    user = update.effective_user
-    chat = update.effective_chat
+    # /dbdump [N] — первые N строк; всю таблицу отдаёт /export
+    limit = 10
+    if context.args and context.args[0].isdigit():
+        limit = max(1, min(int(context.args[0]), DBDUMP_MAX_ROWS))
 
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
-    conn = sqlite3.connect(DB_PATH)
-    cur  = conn.cursor()
-    cur.execute(
-        "SELECT chat_id, user_id, total_xp, first_name, last_name FROM xp LIMIT 10"
-    )
-    rows = cur.fetchall()
-    conn.close()
+    # Строки как они есть в таблице; буфер записи сбросится сам в пределах XP_FLUSH_INTERVAL
+    rows = list(islice(storage.iter_xp(), limit))
 
     if not rows:
         update.message.reply_text("В базе пока нет ни одной записи.", quote=True)
         return
 
-    lines = ["<b>Первые 10 строк из таблицы xp:</b>"]
-    for chat_id, user_id, total_xp, first_name, last_name in rows:
+    lines = [f"<b>Первые {len(rows)} строк из таблицы xp:</b>"]
+    for chat_id, user_id, first_name, last_name, total_xp, _ in rows:
         name = f"{first_name} {last_name}".strip() or f"ID:{user_id}"
         city = get_city_name(chat_id)
         lines.append(f"• {name} ({chat_id}, «{city}») — {int(total_xp)} XP")
 
+    lines.append("Всю таблицу можно выгрузить командой /export.")
     text = "\n".join(lines)
     update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -402,12 +2383,6 @@ def cmd_dbdump(update: Update, context: CallbackContext):
 # ==============================================================================
 
 def cmd_dbpath(update: Update, context: CallbackContext):
-    user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
     path = os.path.abspath(DB_PATH)
     update.message.reply_text(f"Файл базы находится здесь:\n`{path}`", parse_mode=ParseMode.MARKDOWN)
 
@@ -415,26 +2390,571 @@ def cmd_dbpath(update: Update, context: CallbackContext):
 # КОМАНДА /senddb
 # ==============================================================================
 
+def send_snapshot(message: Message):
+    # Копия делается и отправляется в фоне, чтобы не занимать поток обработки
+    fd, path = tempfile.mkstemp(prefix="activity-", suffix=".db")
+    os.close(fd)
+    try:
+        xp_writer.flush()
+        snapshot_db(db, path)
+        with open(path, "rb") as db_file:
+            message.reply_document(document=db_file, filename="activity.db")
+        if isinstance(storage, MemoryStorage):
+            # XP живёт в памяти: в activity.db только служебные таблицы
+            storage.snapshot_to(path)
+            with open(path, "rb") as snapshot_file:
+                message.reply_document(
+                    document=snapshot_file,
+                    filename="activity.snapshot",
+                    caption="XP хранится в памяти (STORAGE_BACKEND=memory): это его снимок, в activity.db его нет."
+                )
+    except Exception as e:
+        message.reply_text(f"Не удалось отправить файл: {e}", quote=True)
+    finally:
+        os.remove(path)
+
 def cmd_senddb(update: Update, context: CallbackContext):
-    user = update.effective_user
-    chat = update.effective_chat
+    threading.Thread(target=send_snapshot, args=(update.message,), name="senddb", daemon=True).start()
+
+# ==============================================================================
+# КОМАНДА /export
+# ==============================================================================
+
+def send_export(message: Message, fmt: str, chat_id, min_xp: float):
+    fd, path = tempfile.mkstemp(prefix="xp-", suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        xp_writer.flush()
+        count = write_export(path, storage, fmt, chat_id, min_xp)
+        scope = f"«{get_city_name(chat_id)}»" if chat_id is not None else "все города"
+        with open(path, "rb") as export_file:
+            message.reply_document(
+                document=export_file,
+                filename=f"xp.{fmt}.gz",
+                caption=f"Выгрузка xp: {scope}, от {min_xp:g} XP, строк: {count}"
+            )
+    except Exception as e:
+        message.reply_text(f"Не удалось выгрузить таблицу: {e}", quote=True)
+    finally:
+        os.remove(path)
+
+def cmd_export(update: Update, context: CallbackContext):
+    # /export [csv|jsonl] [город] [мин. XP]
+
+    args = list(context.args or [])
+    fmt = "csv"
+    if args and args[0].lower() in EXPORT_FORMATS:
+        fmt = args.pop(0).lower()
+    min_xp = 0
+    if args and args[-1].isdigit():
+        min_xp = int(args.pop())
+
+    chat_id = None
+    city_part = " ".join(args).strip()
+    if city_part:
+        chat_id = cities.find(city_part)
+        if chat_id is None:
+            update.message.reply_text(
+                f"Город «{city_part}» не найден. Доступные: {cities.names()}.",
+                quote=True
+            )
+            return
+
+    threading.Thread(
+        target=send_export, args=(update.message, fmt, chat_id, min_xp), name="export", daemon=True
+    ).start()
 
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
+# ==============================================================================
+# КОМАНДА /backup
+# ==============================================================================
+
+def save_backup(message: Message):
+    try:
+        paths = backup_now(db)
+    except Exception as e:
+        message.reply_text(f"Не удалось сделать копию: {e}", quote=True)
         return
+    lines = "\n".join(f"`{os.path.abspath(path)}`" for path in paths)
+    message.reply_text(f"Копия сохранена:\n{lines}", parse_mode=ParseMode.MARKDOWN)
+
+def cmd_backup(update: Update, context: CallbackContext):
+    threading.Thread(target=save_backup, args=(update.message,), name="backup", daemon=True).start()
+
+# ==============================================================================
+# КОМАНДА /cities
+# ==============================================================================
+
+def cmd_cities(update: Update, context: CallbackContext):
+    # /cities — текущий список; /cities reload — перечитать cities.json сейчас
+    if context.args and context.args[0].lower() == "reload":
+        try:
+            cities.reload(force=True)
+        except Exception as e:
+            update.message.reply_text(f"Не удалось перечитать список городов: {e}", quote=True)
+            return
+    lines = [f"Городов: {len(cities.all())}"]
+    for city in cities.all():
+        lines.append(f"• {city['name']} ({city['chat_id']})")
+    update.message.reply_text("\n".join(lines), quote=True)
+
+# ==============================================================================
+# КОМАНДА /maintenance
+# ==============================================================================
+
+def run_maintenance_command(message: Message):
+    if not maintain(message.chat_id):
+        message.reply_text("Обслуживание базы уже идёт.", quote=True)
+
+def cmd_maintenance(update: Update, context: CallbackContext):
+    update.message.reply_text("Запускаю обслуживание базы, отчёт придёт сюда.", quote=True)
+    threading.Thread(
+        target=run_maintenance_command, args=(update.message,), name="maintenance", daemon=True
+    ).start()
+
+# ==============================================================================
+# МЕДЛЕННЫЕ АПДЕЙТЫ (/slow) И ПРОФИЛИРОВАНИЕ (/profile)
+# ==============================================================================
 
+class SlowUpdateLog:
+    # Кольцевой буфер апдейтов, обработка которых заняла больше threshold.
+    # Трасса заводится на каждый апдейт (словарь на поток), а в буфер
+    # попадает только медленный — без текста сообщения, лишь откуда и что.
+
+    def __init__(self, size: int, threshold: float):
+        self.threshold = threshold
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, update: Update, kind: str, received: float = None):
+        # received — момент приёма апдейта, чтобы отделить ожидание в очереди
+        trace = update_trace.current = {"handlers": [], "sqlite": 0.0, "api": 0.0}
+        started = time.perf_counter()
+        wait = started - received if received else 0.0
+        try:
+            yield trace
+        finally:
+            update_trace.current = None
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.threshold:
+                chat, user = update.effective_chat, update.effective_user
+                with self._lock:
+                    self._entries.append({
+                        "ts": time.time(),
+                        "update_id": update.update_id,
+                        "class": kind,
+                        "chat_id": chat.id if chat else None,
+                        "user_id": user.id if user else None,
+                        "seconds": elapsed,
+                        "wait": wait,
+                        **trace,
+                    })
+
+    def recent(self, n: int) -> list:
+        # Новые сверху
+        with self._lock:
+            return list(islice(reversed(self._entries), n))
+
+slow_updates = SlowUpdateLog(SLOW_UPDATE_LOG_SIZE, SLOW_UPDATE_SECONDS)
+
+def process_update_traced(update: Update, kind: str, received: float = None):
+    with slow_updates.trace(update, kind, received):
+        dispatcher.process_update(update)
+
+def cmd_slow(update: Update, context: CallbackContext):
+    # /slow [N] — последние N медленных апдейтов
+    limit = 10
+    if context.args and context.args[0].isdigit():
+        limit = max(1, min(int(context.args[0]), 30))
+    entries = slow_updates.recent(limit)
+    if not entries:
+        update.message.reply_text(
+            f"Апдейтов дольше {slow_updates.threshold * 1000:.0f} мс не было.", quote=True
+        )
+        return
+    lines = [f"Последние апдейты дольше {slow_updates.threshold * 1000:.0f} мс:"]
+    for entry in entries:
+        moment = datetime.fromtimestamp(entry["ts"]).strftime("%d.%m %H:%M:%S")
+        chain = " → ".join(entry["handlers"]) or "без хэндлеров"
+        lines.append(
+            f"• {moment} {entry['class']}, чат {entry['chat_id']}: {entry['seconds'] * 1000:.0f} мс "
+            f"(очередь {entry['wait'] * 1000:.0f}, SQLite {entry['sqlite'] * 1000:.0f}, "
+            f"API {entry['api'] * 1000:.0f}) — {chain}"
+        )
+    update.message.reply_text("\n".join(lines), quote=True)
+
+def frame_stack(frame) -> list:
+    # Стек от корня к вершине в виде «файл:функция»
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def sample_stacks(seconds: float, interval: float) -> tuple:
+    # Выборочный профиль: раз в interval снимаем стеки всех потоков, кроме
+    # своего. Потоки не останавливаются и не инструментируются, поэтому
+    # профиль можно снимать под боевой нагрузкой. Результат — свёрнутые
+    # стеки «поток;кадр;кадр число», как их читают flamegraph.pl и speedscope.
+    own = threading.get_ident()
+    counts = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            key = ";".join([names.get(ident, str(ident))] + frame_stack(frame))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+profile_lock = threading.Lock()
+
+def send_profile(message: Message, seconds: int):
+    fd, path = tempfile.mkstemp(prefix="profile-", suffix=".txt")
+    os.close(fd)
     try:
-        with open(DB_PATH, "rb") as db_file:
-            update.message.reply_document(document=db_file, filename="activity.db")
+        counts, samples = sample_stacks(seconds, PROFILE_SAMPLE_INTERVAL)
+        with open(path, "w", encoding="utf-8") as profile_file:
+            for key, n in sorted(counts.items(), key=lambda item: -item[1]):
+                profile_file.write(f"{key} {n}\n")
+        with open(path, "rb") as profile_file:
+            message.reply_document(
+                document=profile_file,
+                filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt",
+                caption=f"Профиль за {seconds} с: снимков {samples}, разных стеков {len(counts)}"
+            )
     except Exception as e:
-        update.message.reply_text(f"Не удалось отправить файл: {e}", quote=True)
+        message.reply_text(f"Не удалось снять профиль: {e}", quote=True)
+    finally:
+        profile_lock.release()
+        os.remove(path)
+
+def cmd_profile(update: Update, context: CallbackContext):
+    # /profile [секунды] — профиль всех потоков за окно, файлом
+    seconds = 10
+    if context.args and context.args[0].isdigit():
+        seconds = max(1, min(int(context.args[0]), PROFILE_MAX_SECONDS))
+    if not profile_lock.acquire(blocking=False):
+        update.message.reply_text("Профиль уже снимается, дождитесь файла.", quote=True)
+        return
+    update.message.reply_text(f"Снимаю профиль {seconds} с…", quote=True)
+    threading.Thread(
+        target=send_profile, args=(update.message, seconds), name="profile", daemon=True
+    ).start()
+
+# ==============================================================================
+# ДВИЖОК РАССЫЛКИ
+# ==============================================================================
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        # 0 — токен взят; иначе сколько секунд ждать до следующего
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+# Вложения, которые Telegram собирает в альбом; file_id берём из исходного
+# сообщения, так что файлы повторно не загружаются
+ALBUM_MEDIA = {
+    "photo": lambda m: InputMediaPhoto(
+        m.photo[-1].file_id, caption=m.caption, caption_entities=m.caption_entities or None
+    ),
+    "video": lambda m: InputMediaVideo(
+        m.video.file_id, caption=m.caption, caption_entities=m.caption_entities or None
+    ),
+    "document": lambda m: InputMediaDocument(
+        m.document.file_id, caption=m.caption, caption_entities=m.caption_entities or None
+    ),
+    "audio": lambda m: InputMediaAudio(
+        m.audio.file_id, caption=m.caption, caption_entities=m.caption_entities or None
+    ),
+}
+
+def album_media(msg: Message):
+    for attr, make in ALBUM_MEDIA.items():
+        if getattr(msg, attr):
+            return make(msg)
+    return None
+
+def group_broadcast_items(messages: list) -> list:
+    # Сообщения с одним media_group_id становятся одним элементом-списком
+    # на месте первого из них, остальные идут по одному. Альбом, в котором
+    # есть что-то кроме фото, видео, документов и аудио, шлём поштучно.
+    items, albums = [], {}
+    for msg in messages:
+        if not msg.media_group_id:
+            items.append(msg)
+            continue
+        album = albums.get(msg.media_group_id)
+        if album is None:
+            album = albums[msg.media_group_id] = []
+            items.append(album)
+        album.append(msg)
+
+    grouped = []
+    for item in items:
+        if not isinstance(item, list):
+            grouped.append(item)
+            continue
+        item.sort(key=lambda m: m.message_id)
+        if len(item) > 1 and all(album_media(m) for m in item):
+            grouped.append(item)
+        else:
+            grouped.extend(item)
+    return grouped
+
+class BroadcastEngine:
+    # Каждый чат получает сообщения строго по порядку: в полёте не больше
+    # одного запроса на чат, а разные чаты идут параллельно. Ожидание токена
+    # чата (BROADCAST_CHAT_RATE, по умолчанию 20 в минуту) не занимает поток
+    # пула: run() сам держит очередь чатов по времени готовности и отдаёт
+    # пулу только отправки, для которых токен чата уже взят. Токен из общего
+    # ведра бота берётся перед самим запросом. Альбом уходит одним
+    # send_media_group, то есть за один запрос и один токен.
+
+    def __init__(self, bot: Bot, workers: int):
+        self.bot = bot
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broadcast")
+        self._global_bucket = TokenBucket(BROADCAST_GLOBAL_RATE, BROADCAST_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self.active = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(BROADCAST_CHAT_RATE, BROADCAST_CHAT_BURST)
+                self._chat_buckets[chat_id] = bucket
+            return bucket
+
+    def _send(self, chat_id: int, item) -> int:
+        # Токен чата для первой попытки уже взят в run(); повторы (редкие)
+        # ждут его сами. Возвращает chat_id, в который сообщение ушло (он
+        # меняется при миграции группы)
+        attempt = 0
+        reserved = True
+        while True:
+            if not reserved:
+                self._chat_bucket(chat_id).acquire()
+            reserved = False
+            self._global_bucket.acquire()
+            try:
+                if isinstance(item, list):
+                    self.bot.send_media_group(chat_id=chat_id, media=[album_media(m) for m in item])
+                else:
+                    self.bot.copy_message(
+                        chat_id=chat_id,
+                        from_chat_id=item.chat.id,
+                        message_id=item.message_id
+                    )
+                return chat_id
+            except RetryAfter as e:
+                # Ждём ровно столько, сколько попросил сервер, попытку не расходуем
+                time.sleep(e.retry_after + 0.1)
+            except ChatMigrated as e:
+                chat_id = e.new_chat_id
+            except (BadRequest, Unauthorized):
+                raise
+            except NetworkError:
+                attempt += 1
+                if attempt > BROADCAST_MAX_RETRIES:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+
+    @contextmanager
+    def session(self):
+        # Рассылка вместе с отчётом: shutdown() ждёт, пока такие закончатся
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+                self._idle.notify_all()
+
+    def run(self, messages: list, chat_ids: list) -> tuple:
+        # sent и total считаются в сообщениях, альбом — по числу вложений.
+        # После shutdown() новые отправки не начинаются: run() дожидается
+        # тех, что в полёте, и возвращает частичный результат
+        started = time.monotonic()
+        BROADCAST_QUEUED.inc(len(messages) * len(chat_ids))
+        items = group_broadcast_items(messages)
+        results = {chat_id: {"sent": 0, "total": len(messages), "error": None} for chat_id in chat_ids}
+        targets = {chat_id: chat_id for chat_id in chat_ids}
+        queues = {chat_id: deque(items) for chat_id in chat_ids if items}
+        ready = [(started, order, chat_id) for order, chat_id in enumerate(queues)]  # куча по времени
+        in_flight = {}
+        while ready or in_flight:
+            if self._stopping.is_set():
+                ready = []
+            now = time.monotonic()
+            while ready and ready[0][0] <= now and len(in_flight) < self.workers and not self._stopping.is_set():
+                _, order, chat_id = heapq.heappop(ready)
+                wait = self._chat_bucket(targets[chat_id]).try_acquire()
+                if wait:
+                    heapq.heappush(ready, (now + wait, order, chat_id))
+                    continue
+                future = self._executor.submit(self._send, targets[chat_id], queues[chat_id][0])
+                in_flight[future] = (order, chat_id)
+
+            timeout = None
+            if ready and len(in_flight) < self.workers:
+                timeout = max(0.0, ready[0][0] - time.monotonic())
+            if not in_flight:
+                self._stopping.wait(timeout)
+                continue
+            done, _ = wait_futures(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                order, chat_id = in_flight.pop(future)
+                result, item = results[chat_id], queues[chat_id].popleft()
+                size = len(item) if isinstance(item, list) else 1
+                try:
+                    targets[chat_id] = future.result()
+                    result["sent"] += size
+                    BROADCAST_SENT.inc(size, status="sent")
+                except Unauthorized as e:
+                    # Бота удалили из чата — остальные сообщения туда тоже не дойдут
+                    result["error"] = str(e)
+                    BROADCAST_SENT.inc(result["total"] - result["sent"], status="failed")
+                    queues[chat_id].clear()
+                except Exception as e:
+                    result["error"] = str(e)
+                    BROADCAST_SENT.inc(size, status="failed")
+                    logger.error(f"Ошибка при рассылке в {chat_id}: {e}")
+                if queues[chat_id]:
+                    heapq.heappush(ready, (time.monotonic(), order, chat_id))
+        for chat_id, queue in queues.items():
+            if queue:
+                results[chat_id]["error"] = results[chat_id]["error"] or "бот остановлен"
+                BROADCAST_SENT.inc(sum(len(i) if isinstance(i, list) else 1 for i in queue), status="failed")
+        return results, time.monotonic() - started
+
+    def shutdown(self, timeout: float):
+        # Пул закрываем, только когда рассылки отправили отчёты, иначе
+        # submit() из их потоков упадёт с RuntimeError
+        self._stopping.set()
+        with self._idle:
+            if not self._idle.wait_for(lambda: self.active == 0, timeout):
+                logger.warning(f"Рассылки не завершились за {timeout:g} с: {self.active}")
+        self._executor.shutdown(wait=True)
+
+broadcast_engine = BroadcastEngine(bot, BROADCAST_WORKERS)
+metrics.gauge("faba_broadcast_active", "Рассылки в процессе", lambda: broadcast_engine.active)
+
+def format_broadcast_report(results: dict, elapsed: float) -> str:
+    sent = sum(r["sent"] for r in results.values())
+    total = sum(r["total"] for r in results.values())
+    lines = [f"Рассылка завершена за {elapsed:.1f} с: доставлено {sent} из {total}."]
+    for chat_id, r in results.items():
+        city = get_city_name(chat_id)
+        name = city if city != "Неизвестно" else str(chat_id)
+        mark = "✅" if r["sent"] == r["total"] else "❌"
+        line = f"{mark} {name} — {r['sent']}/{r['total']}"
+        if r["error"]:
+            line += f": {r['error']}"
+        lines.append(line)
+    lines.append("Чтобы начать заново, нажмите /menu")
+    return "\n".join(lines)
+
+def run_broadcast(admin_chat_id: int, messages: list, chat_ids: list):
+    try:
+        with broadcast_engine.session():
+            results, elapsed = broadcast_engine.run(messages, chat_ids)
+            bot.send_message(chat_id=admin_chat_id, text=format_broadcast_report(results, elapsed))
+    except Exception as e:
+        logger.error(f"Рассылка прервана: {e}")
 
 # ==============================================================================
 # МЕНЮ И РАССЫЛКИ
 # ==============================================================================
 
-user_buffers = {}
-user_waiting = {}
-user_mode = {}
+class BroadcastSessionStore:
+    # Сессии рассылки живут в SQLite, а не в словарях процесса: сообщение,
+    # принятое одним воркером gunicorn, видно /sendall в любом другом.
+    # Сообщения буфера хранятся как JSON объекта Message.
+
+    def __init__(self, database: Database):
+        self.db = database
+
+    def start(self, user_id: int, mode: str):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM broadcast_buffer WHERE user_id = ?", (user_id,))
+            conn.execute(
+                """
+                INSERT INTO broadcast_sessions (user_id, mode, waiting, updated_ts)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    mode = excluded.mode, waiting = 1, updated_ts = excluded.updated_ts
+                """,
+                (user_id, mode, int(time.time()))
+            )
+
+    def is_waiting(self, user_id: int) -> bool:
+        row = self.db.query_one("SELECT waiting FROM broadcast_sessions WHERE user_id = ?", (user_id,))
+        return bool(row and row[0])
+
+    def append(self, user_id: int, message) -> int:
+        # Возвращает, сколько сообщений в буфере после добавления
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO broadcast_buffer (user_id, message) VALUES (?, ?)",
+                (user_id, message.to_json())
+            )
+            return conn.execute(
+                "SELECT COUNT(*) FROM broadcast_buffer WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+
+    def take(self, user_id: int) -> tuple:
+        # Забирает буфер и закрывает сессию одной транзакцией: два воркера
+        # не смогут отправить одну и ту же рассылку дважды. С пустым буфером
+        # сессия остаётся открытой — можно дослать сообщения и повторить /sendall
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT mode FROM broadcast_sessions WHERE user_id = ?", (user_id,)).fetchone()
+            rows = conn.execute(
+                "SELECT message FROM broadcast_buffer WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+            if not rows:
+                return (row[0] if row else None), []
+            conn.execute("DELETE FROM broadcast_buffer WHERE user_id = ?", (user_id,))
+            conn.execute(
+                "UPDATE broadcast_sessions SET mode = NULL, waiting = 0, updated_ts = ? WHERE user_id = ?",
+                (int(time.time()), user_id)
+            )
+        messages = [Message.de_json(json.loads(message), bot) for (message,) in rows]
+        return (row[0] if row else None), messages
+
+broadcast_sessions = BroadcastSessionStore(db)
 
 def main_menu_keyboard(uid: int) -> ReplyKeyboardMarkup:
     kb = [
@@ -448,23 +2968,17 @@ def main_menu_keyboard(uid: int) -> ReplyKeyboardMarkup:
 
 def menu(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
 
     update.message.reply_text("Выберите действие:", reply_markup=main_menu_keyboard(user.id))
 
 def start_test_broadcast(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
 
-    if chat.type != "private" or user.id != YOUR_ID:
+    # Тестовая рассылка — только для владельца, а не для всех админов
+    if user.id != YOUR_ID:
         return
 
-    user_buffers[user.id] = []
-    user_waiting[user.id] = True
-    user_mode[user.id] = "test"
+    broadcast_sessions.start(user.id, "test")
     update.message.reply_text(
         "Отправляйте любые сообщения (текст, фото, стикеры и т. д.).\n"
         "Когда закончите, напишите /sendall."
@@ -472,33 +2986,24 @@ def start_test_broadcast(update: Update, context: CallbackContext):
 
 def start_city_broadcast(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
 
-    user_buffers[user.id] = []
-    user_waiting[user.id] = True
-    user_mode[user.id] = "city"
+    broadcast_sessions.start(user.id, "city")
     update.message.reply_text(
         "Отправляйте любые сообщения для рассылки по всем городам.\n"
         "Когда закончите, напишите /sendall."
     )
 
-def send_chat_list(update: Update, context: CallbackContext):
-    user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
+def render_chat_list() -> str:
     lines = ["Список чатов ФАБА:"]
-    for city in ALL_CITIES:
+    for city in cities.all():
         lines.append(f"<a href='{city['link']}'>{city['name']}</a>")
+    return "\n".join(lines)
 
+def send_chat_list(update: Update, context: CallbackContext):
+    text = response_cache.get_or_render(("chats", cities.version), render_chat_list)
     markup = ReplyKeyboardMarkup([["Назад"]], resize_keyboard=True, one_time_keyboard=True)
     update.message.reply_text(
-        "\n".join(lines),
+        text,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True,
         reply_markup=markup
@@ -506,24 +3011,16 @@ def send_chat_list(update: Update, context: CallbackContext):
 
 def handle_back(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
-
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
 
     update.message.reply_text("Выберите действие:", reply_markup=main_menu_keyboard(user.id))
 
 def add_to_buffer(update: Update, context: CallbackContext):
     user = update.effective_user
-    chat = update.effective_chat
 
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS or not user_waiting.get(user.id):
-        return
-    if update.message.text and update.message.text.startswith("/"):
+    if not broadcast_sessions.is_waiting(user.id):
         return
 
-    user_buffers.setdefault(user.id, []).append(update.message)
-    if len(user_buffers[user.id]) == 1:
+    if broadcast_sessions.append(user.id, update.message) == 1:
         update.message.reply_text(
             "Сообщение добавлено к рассылке.\n"
             "Когда закончите — напишите /sendall, и рассылка уйдет."
@@ -533,78 +3030,431 @@ def sendall(update: Update, context: CallbackContext):
     user = update.effective_user
     chat = update.effective_chat
 
-    if chat.type != "private" or user.id not in ALLOWED_USER_IDS:
-        return
-
-    if not user_buffers.get(user.id):
+    mode, messages = broadcast_sessions.take(user.id)
+    if not messages:
         update.message.reply_text("Нет сообщений для рассылки.")
         return
 
-    if user_mode.get(user.id) == "city":
-        chat_ids = [c["chat_id"] for c in ALL_CITIES]
+    if mode == "city":
+        chat_ids = [c["chat_id"] for c in cities.all()]
     else:
         chat_ids = TEST_SEND_CHATS
 
-    for msg in user_buffers[user.id]:
-        for chat_id in chat_ids:
-            try:
-                bot.copy_message(
-                    chat_id=chat_id,
-                    from_chat_id=msg.chat.id,
-                    message_id=msg.message_id
-                )
-                time.sleep(0.05)
-            except Exception as e:
-                logging.error(f"Ошибка при рассылке: {e}")
-
-    update.message.reply_text("Рассылка завершена.\nЧтобы начать заново, нажмите /menu")
-    user_buffers[user.id] = []
-    user_waiting[user.id] = False
-    user_mode[user.id] = None
+    update.message.reply_text(f"Рассылка запущена: {len(messages)} сообщ. в {len(chat_ids)} чатов.")
+    threading.Thread(
+        target=run_broadcast,
+        args=(chat.id, messages, chat_ids),
+        name="broadcast-run",
+        daemon=True
+    ).start()
 
 # ==============================================================================
 # РЕГИСТРАЦИЯ ХЭНДЛЕРОВ
 # ==============================================================================
 
-valid_chat_ids = {city["chat_id"] for city in ALL_CITIES}
-dispatcher.add_handler(
-    MessageHandler(
-        Filters.chat(valid_chat_ids)
-        & ~Filters.command
-        & (Filters.text | Filters.photo | Filters.video | Filters.document),
-        record_xp
-    ),
-    group=1
+# Фильтр держим отдельно: при перезагрузке городов ему подменяется набор чатов
+city_chat_filter = Filters.chat(chat_id=cities.chat_ids)
+cities.on_reload(lambda index: setattr(city_chat_filter, "chat_ids", index.chat_ids))
+cities_watcher = None
+if CITIES_RELOAD_INTERVAL > 0:
+    cities_watcher = PeriodicTask("cities-reload", CITIES_RELOAD_INTERVAL, cities.reload)
+
+# Ссылку держим: пул при перегрузке засчитывает XP в обход Dispatcher тем же фильтром
+xp_handler = MessageHandler(
+    city_chat_filter
+    & ~Filters.command
+    & (Filters.text | Filters.photo | Filters.video | Filters.document),
+    record_xp
 )
+dispatcher.add_handler(xp_handler, group=1)
+
+# ==============================================================================
+# МАРШРУТИЗАЦИЯ ЛИЧНЫХ СООБЩЕНИЙ
+# ==============================================================================
+
+ROUTE_HITS = metrics.counter("faba_private_route_hits_total", "Личные сообщения по маршруту")
+
+class PrivateRouter:
+    # Один хэндлер на все личные сообщения: доступ проверяется один раз,
+    # команда или кнопка меню находится в словаре по точному тексту, всё
+    # остальное сразу уходит в буфер рассылки. Хэндлеры маршрутов уже не
+    # проверяют ни тип чата, ни список админов.
+
+    def __init__(self, fallback):
+        self.routes = {}
+        self.classes = {}
+        self.fallback = timed_handler(fallback)
+
+    def command(self, name: str, callback, kind: str = "interactive"):
+        self.routes["/" + name] = timed_handler(callback)
+        self.classes["/" + name] = kind
+
+    def button(self, text: str, callback, kind: str = "interactive"):
+        self.routes[text] = timed_handler(callback)
+        self.classes[text] = kind
+
+    def classify(self, text: str) -> str:
+        # Класс апдейта для пула: маршрут заявлен при регистрации, остальное
+        # личное — содержимое для буфера рассылки
+        if text.startswith("/"):
+            command = text.split()[0].partition("@")[0].lower()
+            return self.classes.get(command, "interactive")
+        return self.classes.get(text, "broadcast")
+
+    def dispatch(self, update: Update, context: CallbackContext):
+        user = update.effective_user
+        if not user or user.id not in ALLOWED_USER_IDS:
+            ROUTE_HITS.inc(route="denied")
+            return
+        text = update.message.text or ""
+        if text.startswith("/"):
+            command, *args = text.split()
+            command, _, mention = command.partition("@")
+            if mention and mention.lower() != context.bot.username.lower():
+                ROUTE_HITS.inc(route="unknown")
+                return
+            route = self.routes.get(command.lower())
+            if route is None:
+                ROUTE_HITS.inc(route="unknown")
+                return
+            context.args = args
+            ROUTE_HITS.inc(route=command.lower())
+            return route(update, context)
+        route = self.routes.get(text)
+        if route is None:
+            ROUTE_HITS.inc(route="buffer")
+            return self.fallback(update, context)
+        ROUTE_HITS.inc(route=text)
+        return route(update, context)
+
+private_router = PrivateRouter(add_to_buffer)
+for name, callback in (
+    ("top", cmd_top),
+    ("topcheck", cmd_topcheck),
+    ("rank", cmd_rank),
+    ("dbdump", cmd_dbdump),
+    ("explain", cmd_explain),
+    ("dbpath", cmd_dbpath),
+    ("senddb", cmd_senddb),
+    ("export", cmd_export),
+    ("backup", cmd_backup),
+    ("maintenance", cmd_maintenance),
+    ("cities", cmd_cities),
+    ("slow", cmd_slow),
+    ("profile", cmd_profile),
+    ("menu", menu),
+):
+    private_router.command(name, callback)
+private_router.command("sendall", sendall, kind="broadcast")
+for text, callback in (
+    ("Список чатов ФАБА", send_chat_list),
+    ("Назад", handle_back),
+    ("Рейтинг", cmd_top),
+):
+    private_router.button(text, callback)
+for text, callback in (
+    ("Тестовая рассылка", start_test_broadcast),
+    ("Рассылка по городам", start_city_broadcast),
+):
+    private_router.button(text, callback, kind="broadcast")
+
+def route_private(update: Update, context: CallbackContext):
+    return private_router.dispatch(update, context)
 
-dispatcher.add_handler(CommandHandler("top", cmd_top), group=2)
-dispatcher.add_handler(CommandHandler("rank", cmd_rank), group=2)
-dispatcher.add_handler(CommandHandler("dbdump", cmd_dbdump), group=2)
-dispatcher.add_handler(CommandHandler("dbpath", cmd_dbpath), group=2)
-dispatcher.add_handler(CommandHandler("senddb", cmd_senddb), group=2)
-
-dispatcher.add_handler(CommandHandler("menu", menu), group=2)
-dispatcher.add_handler(MessageHandler(Filters.regex("^Тестовая рассылка$"), start_test_broadcast), group=2)
-dispatcher.add_handler(MessageHandler(Filters.regex("^Рассылка по городам$"), start_city_broadcast), group=2)
-dispatcher.add_handler(MessageHandler(Filters.regex("^Список чатов ФАБА$"), send_chat_list), group=2)
-dispatcher.add_handler(MessageHandler(Filters.regex("^Назад$"), handle_back), group=2)
-dispatcher.add_handler(CommandHandler("sendall", sendall), group=2)
 dispatcher.add_handler(
-    MessageHandler(
-        Filters.chat_type.private & ~Filters.command,
-        add_to_buffer
-    ),
+    MessageHandler(Filters.chat_type.private & Filters.update.message, route_private),
     group=2
 )
 
-dispatcher.add_handler(
-    MessageHandler(
-        Filters.text("Рейтинг") & Filters.chat_type.private & Filters.user(ALLOWED_USER_IDS),
-        cmd_top
-    ),
-    group=2
+# ==============================================================================
+# ПУЛ ОБРАБОТКИ АПДЕЙТОВ
+# ==============================================================================
+
+# Классы апдейтов в порядке обслуживания
+UPDATE_CLASSES = ("interactive", "broadcast", "passive")
+
+def classify_update(update: Update) -> str:
+    # Хэндлеры есть только у личных сообщений (маршрутизатор) и у сообщений
+    # групп (record_xp), поэтому всё, что не личное сообщение, — passive
+    message = update.message
+    if not message or message.chat.type != "private":
+        return "passive"
+    return private_router.classify(message.text or "")
+
+UPDATE_WAIT_SECONDS = metrics.histogram("faba_update_wait_seconds", "Ожидание апдейта в очереди по классу")
+UPDATE_SECONDS      = metrics.histogram("faba_update_seconds", "Время от приёма апдейта до конца обработки по классу")
+
+class UpdateWorkerPool:
+    # Фиксированное число потоков разбирает очереди апдейтов по классам:
+    # свободный поток всегда берёт сначала interactive (команды и кнопки
+    # админов), затем broadcast (буфер и запуск рассылки), затем passive
+    # (XP из групп). Команды админов редки, так что групповые сообщения не
+    # голодают, а /top не стоит за сотнями сообщений.
+    #
+    # interactive и broadcast ограничены maxsize: при переполнении политика
+    # drop отбрасывает апдейт, а delay ждёт место WEBHOOK_QUEUE_TIMEOUT секунд
+    # и затем отказывает, чтобы Telegram повторил доставку позже. Для passive
+    # своя граница: лишнее сообщение не ждёт и не получает 503, а по
+    # passive_overload либо сразу засчитывается через record_xp в вызывающем
+    # потоке (это только лимитер и словари в памяти), либо отбрасывается.
+
+    def __init__(self, workers: int, maxsize: int, policy: str, timeout: float,
+                 passive_maxsize: int, passive_overload: str):
+        if policy not in ("drop", "delay"):
+            raise ValueError(f"Неизвестная политика очереди: {policy}")
+        if passive_overload not in ("coalesce", "shed"):
+            raise ValueError(f"Неизвестная политика перегрузки: {passive_overload}")
+        self.policy = policy
+        self.timeout = timeout
+        self.passive_overload = passive_overload
+        self._limits = {"interactive": maxsize, "broadcast": maxsize, "passive": passive_maxsize}
+        self._queues = {name: deque() for name in UPDATE_CLASSES}
+        self._cond = threading.Condition()
+        self._unfinished = 0
+        self._closed = False
+        self.outcomes = {}
+        self.in_flight = 0
+        self._threads = [
+            threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(pending) for pending in self._queues.values())
+
+    @property
+    def capacity(self) -> int:
+        return sum(self._limits.values())
+
+    def submit(self, update: Update) -> bool:
+        kind = classify_update(update)
+        received = time.perf_counter()
+        with self._cond:
+            if self._closed:
+                self._count(kind, "rejected")
+                return False
+            pending, limit = self._queues[kind], self._limits[kind]
+            if kind == "passive" and len(pending) >= limit:
+                # В обход очереди — только то, что принял бы хэндлер XP
+                # (команды, стикеры, служебные апдейты отбрасываются)
+                coalesce = self.passive_overload == "coalesce" and bool(xp_handler.check_update(update))
+                self._count(kind, "coalesced" if coalesce else "shed")
+            else:
+                if len(pending) >= limit and (
+                    self.policy == "drop"
+                    or not self._cond.wait_for(lambda: self._closed or len(pending) < limit, self.timeout)
+                    or self._closed
+                ):
+                    self._count(kind, "dropped" if self.policy == "drop" else "rejected")
+                    return False
+                pending.append((update, received))
+                self._unfinished += 1
+                self._count(kind, "accepted")
+                self._cond.notify_all()
+                return True
+        if coalesce:
+            self._record_inline(update, received)
+        return True
+
+    def _record_inline(self, update: Update, received: float):
+        try:
+            xp_handler.callback(update, None)
+        except Exception as e:
+            logger.error(f"Ошибка записи XP в обход очереди: {e}")
+        UPDATE_SECONDS.observe(time.perf_counter() - received, **{"class": "passive"})
+
+    def _count(self, kind: str, outcome: str):
+        # Вызывается под self._cond
+        key = (kind, outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def _next(self):
+        # Под self._cond: самый срочный апдейт или None, если пора завершаться
+        while True:
+            for kind in UPDATE_CLASSES:
+                if self._queues[kind]:
+                    update, received = self._queues[kind].popleft()
+                    # Освободилось место — будим submit, ждущие при delay
+                    self._cond.notify_all()
+                    return kind, update, received
+            if self._closed:
+                return None
+            self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                item = self._next()
+                if item is None:
+                    return
+                self.in_flight += 1
+            kind, update, received = item
+            labels = {"class": kind}
+            UPDATE_WAIT_SECONDS.observe(time.perf_counter() - received, **labels)
+            try:
+                process_update_traced(update, kind, received)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта: {e}")
+            finally:
+                UPDATE_SECONDS.observe(time.perf_counter() - received, **labels)
+                with self._cond:
+                    self.in_flight -= 1
+                    self._unfinished -= 1
+                    self._cond.notify_all()
+
+    def join(self):
+        # Ждём, пока разберут всё, что уже принято
+        with self._cond:
+            self._cond.wait_for(lambda: self._unfinished == 0)
+
+    def stats(self) -> dict:
+        with self._cond:
+            outcomes = {}
+            for (kind, outcome), n in self.outcomes.items():
+                outcomes[outcome] = outcomes.get(outcome, 0) + n
+            return {
+                "depth": {kind: len(pending) for kind, pending in self._queues.items()},
+                "in_flight": self.in_flight,
+                "capacity": dict(self._limits),
+                "workers": len(self._threads),
+                "policy": self.policy,
+                "passive_overload": self.passive_overload,
+                **{name: outcomes.get(name, 0) for name in ("accepted", "dropped", "rejected", "coalesced", "shed")},
+            }
+
+    def shutdown(self):
+        # Перестаём принимать апдейты и дожидаемся, пока очереди разберут
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+update_pool = UpdateWorkerPool(
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_QUEUE_POLICY, WEBHOOK_QUEUE_TIMEOUT,
+    WEBHOOK_PASSIVE_QUEUE_SIZE, WEBHOOK_PASSIVE_OVERLOAD
 )
 
+# Каждый зарегистрированный хэндлер меряется в faba_handler_seconds
+for handlers in dispatcher.handlers.values():
+    for handler in handlers:
+        handler.callback = timed_handler(handler.callback)
+
+metrics.gauge("faba_updates_in_flight", "Апдейты, которые сейчас обрабатывает Dispatcher",
+              lambda: update_pool.in_flight)
+metrics.gauge("faba_update_queue_depth", "Апдейты в очереди на обработку по классу",
+              lambda: {(("class", kind),): n for kind, n in update_pool.stats()["depth"].items()})
+metrics.gauge("faba_updates_total", "Апдейты, пришедшие в /webhook, по классу и исходу", lambda: {
+    (("class", kind), ("outcome", outcome)): n for (kind, outcome), n in dict(update_pool.outcomes).items()
+}, kind="counter")
+metrics.gauge("faba_threads", "Живые потоки процесса", threading.active_count)
+metrics.gauge("faba_xp_pending_keys", "Ключи XP, ждущие записи в базу", xp_writer.pending_count)
+
+# ==============================================================================
+# ОТСЕВ ПОВТОРНЫХ АПДЕЙТОВ (по update_id)
+# ==============================================================================
+
+class UpdateDeduplicator:
+    # Последние size значений update_id: кольцо deque для порядка вытеснения
+    # и set для O(1) проверки. С базой новые id дописываются пачкой раз в
+    # flush_interval, а при старте кольцо заполняется последними из seen_updates.
+    # shared — несколько воркеров: id, которого нет в своём кольце, сразу
+    # вставляется в seen_updates, и если там он уже был, это дубль от соседа.
+
+    def __init__(self, size: int, database: Database = None, shared: bool = False):
+        self.size = size
+        self.database = database
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._order = deque()
+        self._ids = set()
+        self._pending = []
+
+    def seen(self, update_id: int) -> bool:
+        # True, если апдейт уже приходил; иначе запоминает его
+        with self._lock:
+            if update_id in self._ids:
+                return True
+            self._remember(update_id)
+            if self.database is not None and not self.shared:
+                self._pending.append(update_id)
+        return self.shared and not self._claim(update_id)
+
+    def _claim(self, update_id: int) -> bool:
+        # True, если id записал этот процесс. Ошибка базы — не повод терять
+        # апдейт: считаем его новым
+        try:
+            with self.database.transaction() as conn:
+                return conn.execute(
+                    "INSERT OR IGNORE INTO seen_updates (update_id, seen_ts) VALUES (?, ?)",
+                    (update_id, int(time.time()))
+                ).rowcount == 1
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось отметить update_id {update_id}: {e}")
+            return True
+
+    def forget(self, update_id: int):
+        # Апдейт не принят (503) — Telegram пришлёт его снова, и это не дубль.
+        # Запись в кольце остаётся и просто вытеснится в свой черёд
+        with self._lock:
+            self._ids.discard(update_id)
+            if update_id in self._pending:
+                self._pending.remove(update_id)
+        if self.shared:
+            with self.database.transaction() as conn:
+                conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+    def _remember(self, update_id: int):
+        if len(self._order) >= self.size:
+            self._ids.discard(self._order.popleft())
+        self._order.append(update_id)
+        self._ids.add(update_id)
+
+    def load(self):
+        rows = self.database.query(
+            "SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (self.size,)
+        )
+        with self._lock:
+            for (update_id,) in reversed(rows):
+                if update_id not in self._ids:
+                    self._remember(update_id)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        # В shared id уже в базе — остаётся только подрезать таблицу
+        if not batch and not self.shared:
+            return
+        now = int(time.time())
+        try:
+            with self.database.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO seen_updates (update_id, seen_ts) VALUES (?, ?)",
+                    [(update_id, now) for update_id in batch]
+                )
+                # В базе держим столько же последних id, сколько в памяти
+                conn.execute(
+                    "DELETE FROM seen_updates WHERE update_id < ("
+                    "SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT 1 OFFSET ?)",
+                    (self.size - 1,)
+                )
+        except Exception:
+            with self._lock:
+                self._pending = batch + self._pending
+            raise
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_SIZE, db if UPDATE_DEDUP_PERSIST else None, UPDATE_DEDUP_SHARED)
+dedup_flusher = None
+if UPDATE_DEDUP_PERSIST:
+    update_dedup.load()
+    dedup_flusher = PeriodicTask("update-dedup-flush", UPDATE_DEDUP_FLUSH_INTERVAL, update_dedup.flush)
+
+UPDATES_DUPLICATE = metrics.counter("faba_duplicate_updates_total", "Повторно доставленные апдейты, отброшенные до Dispatcher")
+
 # ==============================================================================
 # WEBHOOK-РУЧКА
 # ==============================================================================
@@ -612,10 +3462,27 @@ dispatcher.add_handler(
 @app.route('/webhook', methods=['POST'])
 def webhook():
     data = request.get_json(force=True)
+    # Апдейт — JSON-объект с целым update_id; остальное не разбираем
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        return "Bad Request", 400
     update = Update.de_json(data, bot)
-    threading.Thread(target=dispatcher.process_update, args=(update,)).start()
+    if update_dedup.seen(update.update_id):
+        UPDATES_DUPLICATE.inc()
+        return "OK", 200
+    if not update_pool.submit(update) and update_pool.policy == "delay":
+        # 503 — Telegram повторит доставку, когда очередь разгрузится
+        update_dedup.forget(update.update_id)
+        return "Busy", 503
     return "OK", 200
 
+@app.route('/queue', methods=['GET'])
+def queue_stats():
+    return update_pool.stats(), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route('/ping', methods=['GET'])
 def ping():
     return "pong", 200
@@ -624,15 +3491,135 @@ def ping():
 # УСТАНОВКА WEBHOOK
 # ==============================================================================
 
-try:
-    bot.delete_webhook(drop_pending_updates=True)
-    bot.set_webhook(f"{WEBHOOK_URL}/webhook")
-    logger.info(f"Webhook установлен: {WEBHOOK_URL}/webhook")
-except Exception as e:
-    logger.error(f"Не удалось установить webhook: {e}")
+def claim_once(key: str, value: str) -> bool:
+    # True только для первого процесса, записавшего это значение ключа
+    with db.transaction() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row and row[0] == value:
+            return False
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+    return True
+
+def deploy_id() -> str:
+    # Одного pid мастера мало: в контейнере он всегда 1, и отметка в meta
+    # пережила бы передеплой. Время запуска процесса (поле 22 в /proc/<pid>/stat,
+    # в тиках с загрузки) вместе с boot_id у каждого запуска своё
+    if DEPLOY_ID:
+        return DEPLOY_ID
+    ppid = os.getppid()
+    try:
+        with open(f"/proc/{ppid}/stat") as src:
+            # Имя процесса в скобках может содержать пробелы — режем после него
+            started = src.read().rsplit(")", 1)[1].split()[19]
+        with open("/proc/sys/kernel/random/boot_id") as src:
+            boot_id = src.read().strip()
+    except (OSError, IndexError):
+        logger.warning("Нет /proc: задайте DEPLOY_ID, иначе webhook ставится по pid родителя")
+        return str(ppid)
+    return f"{boot_id}:{ppid}:{started}"
+
+def setup_webhook(force: bool = False):
+    marker = f"{deploy_id()}|{WEBHOOK_URL}"
+    if not force and not claim_once("webhook", marker):
+        logger.info("Webhook уже установлен другим воркером этого развёртывания")
+        return
+    try:
+        bot.set_webhook(f"{WEBHOOK_URL}/webhook", drop_pending_updates=WEBHOOK_DROP_PENDING)
+        logger.info(f"Webhook установлен: {WEBHOOK_URL}/webhook")
+    except Exception as e:
+        # Снимаем отметку, чтобы следующий воркер или перезапуск попробовал снова
+        with db.transaction() as conn:
+            conn.execute("DELETE FROM meta WHERE key = 'webhook' AND value = ?", (marker,))
+        logger.error(f"Не удалось установить webhook: {e}")
+
+if WEBHOOK_SETUP == "auto":
+    setup_webhook()
+
+# ==============================================================================
+# ДОГРУЗКА РЕЙТИНГА ОТ СОСЕДНИХ ВОРКЕРОВ
+# ==============================================================================
+
+class LeaderboardSync:
+    # Раз в интервал читает строки xp, изменённые с прошлого раза, с запасом
+    # lag секунд: соседний воркер пишет в базу время сообщения, а сбрасывает
+    # буфер позже. Целиком рейтинг перечитывается, только когда сменилась
+    # эпоха в meta — её двигает обслуживание, убравшее строки в архив.
+
+    def __init__(self, store: XpStorage, lag: float):
+        self.store = store
+        self.lag = lag
+        self.epoch = self._epoch()
+        self.since = int(time.time() - lag)
+
+    def _epoch(self):
+        row = db.query_one("SELECT value FROM meta WHERE key = 'leaderboard_epoch'")
+        return row[0] if row else None
+
+    def run(self):
+        started = time.time()
+        epoch = self._epoch()
+        if epoch != self.epoch:
+            reload_leaderboard(self.store)
+            self.epoch = epoch
+        else:
+            # Свой буфер держим, пока читаем: дельта не должна уйти в базу
+            # после чтения и при этом пропасть из pending
+            with xp_writer.paused():
+                xp_rows, totals = self.store.changed_since(self.since)
+                leaderboard.merge(xp_rows, totals, xp_writer.pending)
+            for chat_id in {row[0] for row in xp_rows}:
+                data_versions.bump(chat_id)
+        self.since = int(started - self.lag)
+
+leaderboard_refresher = None
+if LEADERBOARD_REFRESH_INTERVAL > 0 and isinstance(storage, SqliteStorage):
+    leaderboard_sync = LeaderboardSync(storage, XP_FLUSH_INTERVAL * 2 + SQLITE_BUSY_TIMEOUT)
+    leaderboard_refresher = PeriodicTask("leaderboard-refresh", LEADERBOARD_REFRESH_INTERVAL, leaderboard_sync.run)
+
+# ==============================================================================
+# ЗАВЕРШЕНИЕ РАБОТЫ
+# ==============================================================================
+
+def shutdown():
+    update_pool.shutdown()
+    rollup_compactor.stop()
+    if backup_task:
+        backup_task.stop()
+    if maintenance_task:
+        maintenance_task.stop()
+    if cities_watcher:
+        cities_watcher.stop()
+    if dedup_flusher:
+        dedup_flusher.stop()
+        try:
+            update_dedup.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении update_id при остановке: {e}")
+    if leaderboard_refresher:
+        leaderboard_refresher.stop()
+    broadcast_engine.shutdown(BROADCAST_SHUTDOWN_TIMEOUT)
+    try:
+        xp_writer.stop()
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе XP при остановке: {e}")
+    if snapshot_task:
+        snapshot_task.stop()
+    storage.close()
+    db.close_all()
+
+atexit.register(shutdown)
 
 # ==============================================================================
 # ЛОКАЛЬНЫЙ ЗАПУСК (для отладки)
 # ==============================================================================
 if __name__ == "__main__":
+    if sys.argv[1:] == ["set-webhook"]:
+        # Разовая установка webhook при деплое, когда WEBHOOK_SETUP=off
+        setup_webhook(force=True)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Офлайн-нагрузочный прогон bot.py: синтетические апдейты Telegram идут через
+# Flask-ручку /webhook и Dispatcher, а Bot API подменён локальной заглушкой
+# с искусственной задержкой. Результат сравнивается с сохранённым базовым.
+#
+#   python loadtest.py --updates 5000 --clients 4 --api-latency 0.05
+#   python loadtest.py --save-baseline          # записать базовый прогон
+#   python loadtest.py --check 0.2              # упасть при регрессии > 20 %
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import itertools
+from contextlib import contextmanager
+
+# ==============================================================================
+# ЗАГЛУШКА Bot API
+# ==============================================================================
+
+api_calls = {}
+api_calls_lock = threading.Lock()
+api_latency = 0.0
+_message_ids = itertools.count(1_000_000)
+
+class StubRequest:
+    # Подменяет telegram.utils.request.Request: ничего не отправляет в сеть,
+    # считает вызовы по методам и отвечает правдоподобными объектами
+    def __init__(self, *args, **kwargs):
+        self.con_pool_size = kwargs.get("con_pool_size", 1)
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        with api_calls_lock:
+            api_calls[method] = api_calls.get(method, 0) + 1
+        if api_latency:
+            time.sleep(api_latency)
+
+        data = data or {}
+        if method in ("setWebhook", "deleteWebhook"):
+            return True
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        if method == "copyMessage":
+            return {"message_id": next(_message_ids)}
+        chat = {"id": data.get("chat_id", 1), "type": "private"}
+        if method == "sendMediaGroup":
+            return [
+                {"message_id": next(_message_ids), "date": int(time.time()), "chat": chat}
+                for _ in data.get("media", [])
+            ]
+        return {"message_id": next(_message_ids), "date": int(time.time()), "chat": chat, "text": ""}
+
+    def retrieve(self, url, timeout=None):
+        return b""
+
+    def download(self, url, filename, timeout=None):
+        pass
+
+    def stop(self):
+        pass
+
+def import_bot(workdir: str, storage: str):
+    os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+    os.environ.setdefault("WEBHOOK_URL", "https://loadtest.invalid")
+    os.environ["DB_PATH"] = os.path.join(workdir, "activity.db")
+    os.environ["STORAGE_BACKEND"] = storage
+    os.environ["MEMORY_SNAPSHOT_PATH"] = os.path.join(workdir, "activity.snapshot")
+
+    import telegram.utils.request
+    telegram.utils.request.Request = StubRequest
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    return bot
+
+# ==============================================================================
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# ==============================================================================
+
+_ids = itertools.count(1)
+
+def make_message(chat_id: int, chat_type: str, user_id: int, **fields) -> dict:
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "last_name": "Test"},
+    }
+    message.update(fields)
+    return {"update_id": next(_ids), "message": message}
+
+def command(text: str) -> dict:
+    return {
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    }
+
+def make_updates(bot, count: int, users: int, seed: int) -> list:
+    rng = random.Random(seed)
+    chat_ids = [city["chat_id"] for city in bot.cities.all()]
+    admin_id = min(bot.ALLOWED_USER_IDS)
+    city_names = [city["name"] for city in bot.cities.all()]
+    admin_texts = [
+        "/top", "/top 50", "/rank", "/rank неделя",
+        lambda: f"/top {rng.choice(city_names)} 20",
+        lambda: f"/top неделя {rng.choice(city_names)}",
+        lambda: f"/rank {rng.choice(city_names)}",
+    ]
+
+    updates = []
+    for _ in range(count):
+        roll = rng.random()
+        chat_id = rng.choice(chat_ids)
+        user_id = 10_000 + rng.randrange(users)
+        if roll < 0.85:
+            text = "слово " * rng.randrange(1, 80)
+            updates.append(make_message(chat_id, "supergroup", user_id, text=text))
+        elif roll < 0.91:
+            photo = [{"file_id": f"photo{user_id}", "file_unique_id": f"u{user_id}", "width": 90, "height": 90}]
+            updates.append(make_message(chat_id, "supergroup", user_id, photo=photo, caption="подпись"))
+        elif roll < 0.93:
+            document = {"file_id": f"doc{user_id}", "file_unique_id": f"d{user_id}", "file_name": "a.pdf"}
+            updates.append(make_message(chat_id, "supergroup", user_id, document=document))
+        elif roll < 0.95:
+            updates.append(make_message(chat_id, "supergroup", user_id, **command("/start")))
+        else:
+            text = rng.choice(admin_texts)
+            text = text() if callable(text) else text
+            updates.append(make_message(admin_id, "private", admin_id, **command(text)))
+    return updates
+
+# ==============================================================================
+# ИЗМЕРЕНИЯ
+# ==============================================================================
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.lock_waits = []
+        self.lock_errors = 0
+        self.peak_threads = threading.active_count()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def sample_threads(self, stop: threading.Event):
+        while not stop.wait(0.01):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def instrument(bot, recorder: Recorder):
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.record(name, time.perf_counter() - started)
+        return wrapper
+
+    for handlers in bot.dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback.__name__, handler.callback)
+    # Личные сообщения расходятся по маршрутам внутри одного хэндлера
+    router = bot.private_router
+    router.routes = {key: timed(route.__name__, route) for key, route in router.routes.items()}
+    router.fallback = timed(router.fallback.__name__, router.fallback)
+    dispatcher_class = type(bot.dispatcher)
+    dispatcher_class.process_update = timed("process_update", dispatcher_class.process_update)
+
+    # Ожидание блокировки записи SQLite — время до входа в тело транзакции
+    original_transaction = bot.Database.transaction
+
+    @contextmanager
+    def timed_transaction(self):
+        started = time.perf_counter()
+        try:
+            with original_transaction(self) as conn:
+                recorder.lock_waits.append(time.perf_counter() - started)
+                yield conn
+        except bot.sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                recorder.lock_errors += 1
+            raise
+
+    bot.Database.transaction = timed_transaction
+
+# ==============================================================================
+# ПРОГОН
+# ==============================================================================
+
+def run(args) -> dict:
+    global api_latency
+    api_latency = args.api_latency
+    workdir = tempfile.mkdtemp(prefix="faba-loadtest-")
+    bot = import_bot(workdir, args.storage)
+
+    recorder = Recorder()
+    instrument(bot, recorder)
+    updates = make_updates(bot, args.updates, args.users, args.seed)
+
+    stop_sampler = threading.Event()
+    sampler = threading.Thread(target=recorder.sample_threads, args=(stop_sampler,), daemon=True)
+    sampler.start()
+
+    statuses = {}
+    statuses_lock = threading.Lock()
+
+    def post_chunk(chunk: list):
+        client = bot.app.test_client()
+        for data in chunk:
+            started = time.perf_counter()
+            response = client.post("/webhook", json=data)
+            recorder.record("webhook", time.perf_counter() - started)
+            with statuses_lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    clients = [
+        threading.Thread(target=post_chunk, args=(updates[i::args.clients],))
+        for i in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    bot.update_pool.join()
+    bot.xp_writer.flush()
+    elapsed = time.perf_counter() - started
+
+    stop_sampler.set()
+    sampler.join()
+    bot.shutdown()
+
+    handlers = {
+        name: {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+        for name, values in sorted(recorder.timings.items())
+    }
+    waits = recorder.lock_waits or [0.0]
+    return {
+        "params": {
+            "updates": args.updates, "clients": args.clients, "users": args.users,
+            "api_latency": args.api_latency, "seed": args.seed, "storage": args.storage,
+        },
+        "elapsed_s": elapsed,
+        "throughput_ups": args.updates / elapsed,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "handlers": handlers,
+        "sqlite": {
+            "transactions": len(recorder.lock_waits),
+            "lock_wait_total_ms": sum(waits) * 1000,
+            "lock_wait_p99_ms": percentile(waits, 99) * 1000,
+            "lock_errors": recorder.lock_errors,
+        },
+        "api_calls": dict(sorted(api_calls.items())),
+        "peak_threads": recorder.peak_threads,
+    }
+
+# ==============================================================================
+# ОТЧЁТ И СРАВНЕНИЕ С БАЗОВЫМ ПРОГОНОМ
+# ==============================================================================
+
+def change(current: float, base: float) -> str:
+    if not base:
+        return ""
+    return f" ({(current - base) / base:+.0%})"
+
+def print_report(result: dict, baseline: dict = None):
+    base_handlers = (baseline or {}).get("handlers", {})
+    print(f"Апдейтов: {result['params']['updates']}, клиентов: {result['params']['clients']}, "
+          f"задержка API: {result['params']['api_latency'] * 1000:.0f} мс")
+    print(f"Время: {result['elapsed_s']:.2f} с, пропускная способность: "
+          f"{result['throughput_ups']:.0f} апд/с"
+          f"{change(result['throughput_ups'], (baseline or {}).get('throughput_ups'))}")
+    print(f"Ответы /webhook: {result['statuses']}")
+    print(f"Пик потоков: {result['peak_threads']}"
+          f"{change(result['peak_threads'], (baseline or {}).get('peak_threads'))}")
+    sqlite = result["sqlite"]
+    print(f"SQLite: транзакций {sqlite['transactions']}, ожидание блокировки "
+          f"{sqlite['lock_wait_total_ms']:.1f} мс (p99 {sqlite['lock_wait_p99_ms']:.2f} мс), "
+          f"ошибок locked: {sqlite['lock_errors']}")
+    print(f"Вызовы Bot API: {result['api_calls']}")
+    print()
+    print(f"{'хэндлер':<22}{'вызовов':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, stats in result["handlers"].items():
+        base = base_handlers.get(name, {})
+        print(f"{name:<22}{stats['count']:>9}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{change(stats['p95_ms'], base.get('p95_ms'))}")
+
+def regressions(result: dict, baseline: dict, threshold: float) -> list:
+    found = []
+    if result["throughput_ups"] < baseline["throughput_ups"] * (1 - threshold):
+        found.append(f"пропускная способность {result['throughput_ups']:.0f} < "
+                     f"{baseline['throughput_ups']:.0f} апд/с")
+    for name, stats in result["handlers"].items():
+        base = baseline["handlers"].get(name)
+        if base and stats["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            found.append(f"{name}: p95 {stats['p95_ms']:.2f} > {base['p95_ms']:.2f} мс")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон bot.py без сети")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=4, help="параллельных отправителей в /webhook")
+    parser.add_argument("--users", type=int, default=2000, help="уникальных пользователей в группах")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка заглушки Bot API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite",
+                        help="хранилище XP (STORAGE_BACKEND)")
+    parser.add_argument("--baseline", default="loadtest_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить прогон как базовый")
+    parser.add_argument("--check", type=float, default=None, metavar="ДОЛЯ",
+                        help="код возврата 1, если хуже базового больше чем на долю")
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != result["params"]:
+            print("⚠️ Параметры базового прогона отличаются, сравнение приблизительное\n")
+
+    print_report(result, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nБазовый прогон сохранён: {args.baseline}")
+    elif baseline and args.check is not None:
+        found = regressions(result, baseline, args.check)
+        if found:
+            print("\nРегрессии относительно базового прогона:")
+            for line in found:
+                print(f"• {line}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()